@@ -0,0 +1,98 @@
+"""
+Micro-benchmark of the per-step overhead of derivative strategy creation.
+
+Compares the operator evaluation with the Derivative strategy created for every
+application of the operator (old behaviour) and with the persistent strategy
+built once. The derivative tape (memoized forward passes and lower order
+derivatives) is cleared before every term, so only the strategy creation is
+compared. Operator.pde_compute, which uses the tape and (in 'NN' mode) evaluates
+all stencil grids in one forward pass, is timed separately.
+"""
+import torch
+import numpy as np
+import sys
+import os
+import time
+
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+sys.path.append('../')
+sys.path.pop()
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+
+from tedeous.input_preprocessing import Equation
+from tedeous.solver import grid_format_prepare
+from tedeous.derivative import Derivative
+from tedeous.eval import Operator
+from tedeous.device import solver_device
+from tedeous.models import mat_model
+
+solver_device('cpu')
+
+x = torch.from_numpy(np.linspace(0, 1, 41))
+t = torch.from_numpy(np.linspace(0, 1, 41))
+
+wave_eq = {
+    '4*d2u/dx2**1':
+        {
+            'coeff': 4,
+            'd2u/dx2': [0, 0],
+            'pow': 1
+        },
+    '-d2u/dt2**1':
+        {
+            'coeff': -1,
+            'd2u/dt2': [1, 1],
+            'pow': 1
+        }
+}
+
+bnd1 = torch.cartesian_prod(x, torch.from_numpy(np.array([0], dtype=np.float64))).float()
+bndval1 = torch.sin(np.pi * bnd1[:, 0])
+bconds = [[bnd1, bndval1, 'dirichlet']]
+
+n_steps = 200
+
+for mode in ['mat', 'autograd', 'NN']:
+    if mode == 'mat':
+        grid = grid_format_prepare([x, t], mode='mat').float()
+        model = mat_model(grid, wave_eq)
+    else:
+        grid = grid_format_prepare([x, t], mode=mode).float()
+        model = torch.nn.Sequential(
+            torch.nn.Linear(2, 100),
+            torch.nn.Tanh(),
+            torch.nn.Linear(100, 100),
+            torch.nn.Tanh(),
+            torch.nn.Linear(100, 1))
+
+    equation = Equation(grid, wave_eq, bconds, h=0.01).set_strategy(mode)
+    operator = Operator(grid, equation.operator_prepare(), model, mode, None, 2)
+
+    def apply_operator(derivative_cls, prepared_operator, grid_points):
+        total = 0
+        for term in prepared_operator:
+            derivative_cls.clear_tape()
+            total = total + derivative_cls.take_derivative(prepared_operator[term], grid_points)
+        return total
+
+    start = time.time()
+    for _ in range(n_steps):
+        derivative_cls = Derivative(operator.model, operator.derivative_points).set_strategy(mode)
+        apply_operator(derivative_cls, operator.prepared_operator[0], operator.sorted_grid)
+    time_old = (time.time() - start) / n_steps
+
+    derivative_cls = Derivative(operator.model, operator.derivative_points).set_strategy(mode)
+    start = time.time()
+    for _ in range(n_steps):
+        apply_operator(derivative_cls, operator.prepared_operator[0], operator.sorted_grid)
+    time_new = (time.time() - start) / n_steps
+
+    start = time.time()
+    for _ in range(n_steps):
+        operator.derivative_cls.clear_tape()
+        operator.pde_compute()
+    time_tape = (time.time() - start) / n_steps
+
+    print('mode={} strategy per call: {:.6f} s/step, persistent strategy: {:.6f} s/step, '
+          'pde_compute with tape: {:.6f} s/step'.format(mode, time_old, time_new, time_tape))
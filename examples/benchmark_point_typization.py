@@ -0,0 +1,69 @@
+"""
+Benchmark of the grid points typization (Points_type.grid_sort).
+
+Compares the Delaunay based typization with per point loop (old behaviour)
+and the vectorized typization with per-axis bounds for tensor product grids.
+"""
+import torch
+import numpy as np
+import sys
+import os
+import time
+
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+sys.path.append('../')
+sys.path.pop()
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+
+from tedeous.points_type import Points_type
+
+# the old implementation is too slow for the largest grids
+max_points_old = {2: 10 ** 5, 3: 2 * 10 ** 4}
+
+
+def grid_sort_old(grid):
+    direction_list = []
+    for axis in range(grid.shape[1]):
+        for direction in range(2):
+            direction_list.append(
+                Points_type.in_hull(Points_type.shift_points(
+                    grid, axis, (-1) ** direction * 0.0001), grid))
+    direction_list = np.transpose(np.array(direction_list))
+
+    point_type = {}
+    for i, point in enumerate(grid):
+        if np.all(direction_list[i]):
+            point_type[point] = 'central'
+        else:
+            p_type = ''
+            for j in range(0, len(direction_list[i]), 2):
+                p_type += 'f' if direction_list[i, j] else 'b'
+            point_type[point] = p_type
+
+    grid_dict = {}
+    for point, p_type in point_type.items():
+        grid_dict.setdefault(p_type, []).append(point)
+    return {p_type: torch.stack(points) for p_type, points in grid_dict.items()}
+
+
+for n_dim in [2, 3]:
+    for n_points in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]:
+        n_nodes = int(round(n_points ** (1 / n_dim)))
+        axes = [torch.linspace(0, 1, n_nodes) for _ in range(n_dim)]
+        grid = torch.cartesian_prod(*axes)
+
+        start = time.time()
+        grid_dict = Points_type(grid).grid_sort()
+        time_new = time.time() - start
+
+        if len(grid) <= max_points_old[n_dim]:
+            start = time.time()
+            grid_dict_old = grid_sort_old(grid)
+            time_old = '{:.4f} s'.format(time.time() - start)
+            assert all(torch.equal(grid_dict[key], grid_dict_old[key]) for key in grid_dict_old)
+        else:
+            time_old = 'skipped'
+
+        print('dim={} points={} old: {}, vectorized: {:.4f} s'.format(
+            n_dim, len(grid), time_old, time_new))
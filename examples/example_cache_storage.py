@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Two solver nodes sharing the cached models through the key-value server.
+
+The first node solves the problem and puts the trained model to the server,
+the second node (with its own cache directory) pulls it and starts from it.
+"""
+import torch
+import numpy as np
+import os
+import sys
+import tempfile
+
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+
+sys.path.append('../')
+sys.path.pop()
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname( __file__ ), '..')))
+
+from tedeous.input_preprocessing import Equation
+from tedeous.solver import Solver
+from tedeous.device import solver_device
+from tedeous.cache import CacheIndex
+from tedeous.cache_storage import KVServer, KVStorage
+
+
+solver_device('cpu')
+
+
+def problem():
+    """
+    u'(t) + u(t) = 0, u(0) = 1, the solution is exp(-t).
+    """
+    t = torch.from_numpy(np.linspace(0, 1, 51)).float()
+    grid = t.reshape(-1, 1)
+
+    bnd = torch.tensor([[0.]])
+    bndval = torch.tensor([1.])
+    bconds = [[bnd, bndval, 'dirichlet']]
+
+    operator = {
+        'du/dt':
+            {
+                'coeff': 1,
+                'du/dt': [0],
+                'pow': 1
+            },
+        'u':
+            {
+                'coeff': 1,
+                'u': [None],
+                'pow': 1
+            }
+    }
+
+    equation = Equation(grid, operator, bconds).set_strategy('autograd')
+    model = torch.nn.Sequential(
+        torch.nn.Linear(1, 32),
+        torch.nn.Tanh(),
+        torch.nn.Linear(32, 32),
+        torch.nn.Tanh(),
+        torch.nn.Linear(32, 1))
+    return grid, equation, model
+
+
+def solve(cache_dir, storage, **kwargs):
+    grid, equation, model = problem()
+    model = Solver(grid, equation, model, 'autograd').solve(
+        lambda_bound=10, verbose=False, print_every=None, learning_rate=1e-3,
+        tmax=2000, use_cache=True, save_always=True, cache_dir=cache_dir,
+        cache_verbose=True, cache_storage=storage, **kwargs)
+    error = (model(grid).reshape(-1) - torch.exp(-grid.reshape(-1))).abs().max().item()
+    return error
+
+
+def stored_models(server):
+    return sorted(key for key in server.storage.list() if key.endswith('.tar'))
+
+
+with KVServer(tempfile.mkdtemp()) as server:
+    print('server is started at {}'.format(server.address))
+
+    # the first node saves the trained model to the server
+    node_1 = tempfile.mkdtemp()
+    error = solve(node_1, KVStorage(server.address), name='node_1')
+    print('node 1: error = {:.2e}, server models = {}'.format(error, stored_models(server)))
+    assert stored_models(server) == ['node_1.tar']
+
+    # the second node pulls it from the server and uses it as the initial model,
+    # the cache of the node holds one model, the pulled one is evicted from
+    # the node and from the server when the new model is saved
+    node_2 = tempfile.mkdtemp()
+    error = solve(node_2, KVStorage(server.address), name='node_2', cache_max_entries=1)
+    print('node 2: error = {:.2e}, server models = {}'.format(error, stored_models(server)))
+    assert stored_models(server) == ['node_2.tar']
+    assert sorted(CacheIndex(node_2).records()) == ['node_2.tar']
+
+    # evicted and never saved models are not found (HTTP 404)
+    for key in ('node_1.tar', 'absent.tar'):
+        try:
+            list(KVStorage(server.address).get(key))
+        except KeyError:
+            print('{} is not found on the server'.format(key))
+        else:
+            raise AssertionError('{} should not be found'.format(key))
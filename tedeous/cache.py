@@ -5,18 +5,36 @@ Created on Tue Aug 24 11:50:12 2021
 @author: user
 """
 import pickle
+import atexit
 import datetime
+import json
+import hashlib
 import torch
 import os
 import glob
 import numpy as np
 import shutil
+import tempfile
+import time
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from typing import Union, Tuple, Any
+from typing import Union, Tuple, Any, Callable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 from tedeous.solution import Solution
 from tedeous.input_preprocessing import Equation, EquationMixin
 from tedeous.device import device_type, check_device
+from tedeous.prepared_cache import PreparedCache
+from tedeous.cache_storage import CacheStorage, LocalStorage, KVStorage, KVServer
+from tedeous.models import Ensemble, FeedForward, FourierNN
 
 
 def count_output(model):
@@ -28,6 +46,236 @@ def count_output(model):
     return output_layer
 
 
+def count_input(model):
+    for layer in model.modules():
+        if hasattr(layer, 'in_features'):
+            return layer.in_features
+    return None
+
+
+def layer_descriptor(layer: torch.nn.Module) -> Union[dict, None]:
+    """
+    Describes torch.nn.Linear, torch.nn.Sequential or parameterless torch.nn
+    activation with default arguments.
+
+    Args:
+        layer: layer to describe.
+
+    Returns:
+        descriptor (see model_from_descriptor) or None if the layer can not be described.
+    """
+    if type(layer) is torch.nn.Linear:
+        return {'type': 'Linear', 'in_features': layer.in_features,
+                'out_features': layer.out_features, 'bias': layer.bias is not None}
+    if type(layer) is torch.nn.Sequential:
+        layers = [layer_descriptor(child) for child in layer]
+        if None in layers or len(layer._parameters) > 0:
+            return None
+        return {'type': 'Sequential', 'layers': layers}
+    name = type(layer).__name__
+    if getattr(torch.nn, name, None) is not type(layer) or len(list(layer.parameters())) > 0:
+        return None
+    try:
+        default = type(layer)()
+    except TypeError:
+        return None
+    return {'type': name} if repr(default) == repr(layer) else None
+
+
+def model_from_descriptor(descriptor: dict) -> torch.nn.Module:
+    """
+    Builds the model (with random parameters) from the descriptor.
+
+    Args:
+        descriptor: model descriptor (see model_descriptor).
+
+    Returns:
+        model.
+    """
+    if descriptor['type'] == 'Linear':
+        return torch.nn.Linear(descriptor['in_features'], descriptor['out_features'],
+                               bias=descriptor['bias'])
+    if descriptor['type'] == 'Sequential':
+        return torch.nn.Sequential(*[model_from_descriptor(layer) for layer in descriptor['layers']])
+    if descriptor['type'] == 'FeedForward':
+        return FeedForward(descriptor['layers'], model_from_descriptor(descriptor['activation']),
+                           parameters=dict.fromkeys(descriptor['parameters'], 0.) or None)
+    if descriptor['type'] == 'FourierNN':
+        return FourierNN(layers=descriptor['layers'], L=descriptor['L'], M=descriptor['M'],
+                         activation=model_from_descriptor(descriptor['activation']),
+                         ones=descriptor['ones'])
+    return getattr(torch.nn, descriptor['type'])()
+
+
+def model_descriptor(model: torch.nn.Module) -> Union[dict, None]:
+    """
+    Describes the architecture of torch.nn.Sequential, models.FeedForward or
+    models.FourierNN, so the model can be rebuilt without pickling it.
+
+    Args:
+        model: model to describe.
+
+    Returns:
+        descriptor or None if the model can not be described.
+    """
+    try:
+        if type(model) is FeedForward:
+            linears = [layer for layer in model.net if type(layer) is torch.nn.Linear]
+            activation = model.net[1] if len(model.net) > 1 else torch.nn.Tanh()
+            descriptor = {'type': 'FeedForward',
+                          'layers': [linears[0].in_features] + [layer.out_features for layer in linears],
+                          'activation': layer_descriptor(activation),
+                          'parameters': list(model.net._parameters.keys())}
+        elif type(model) is FourierNN:
+            descriptor = {'type': 'FourierNN',
+                          'layers': [layer.out_features for layer in model.model[1:]],
+                          'L': list(model.L), 'M': list(model.M),
+                          'activation': layer_descriptor(model.activation),
+                          'ones': model.model[0].ones}
+        else:
+            descriptor = layer_descriptor(model)
+        json.dumps(descriptor)
+        rebuilt = model_from_descriptor(descriptor)
+    except Exception:
+        return None
+    # the description is checked by the rebuilt model
+    state_dict = model.state_dict()
+    rebuilt_state_dict = rebuilt.state_dict()
+    if str(rebuilt) != str(model) or state_dict.keys() != rebuilt_state_dict.keys() or \
+            any(state_dict[key].shape != rebuilt_state_dict[key].shape for key in state_dict):
+        return None
+    return descriptor
+
+
+def output_layer_fit(model: torch.nn.Module, grid: torch.Tensor, target: torch.Tensor) -> bool:
+    """
+    Fits the output layer of the model to the target by the least squares,
+    if the model output is the output of its last torch.nn.Linear layer.
+
+    Args:
+        model: model which output layer is fitted.
+        grid: points where the target is given.
+        target: model output to fit.
+
+    Returns:
+        True if the output layer is fitted.
+    """
+    linears = [layer for layer in model.modules() if isinstance(layer, torch.nn.Linear)]
+    if len(linears) == 0:
+        return False
+    output_layer = linears[-1]
+    captured = {}
+
+    def hook(module, inputs, output):
+        captured['features'] = inputs[0]
+        captured['output'] = output
+
+    handle = output_layer.register_forward_hook(hook)
+    try:
+        with torch.no_grad():
+            output = model(grid)
+    finally:
+        handle.remove()
+    if 'output' not in captured or captured['output'].shape != output.shape or \
+            not torch.equal(captured['output'], output):
+        return False
+
+    features = captured['features'].double()
+    if output_layer.bias is not None:
+        features = torch.hstack((features, torch.ones_like(features[:, :1])))
+    solution = torch.linalg.lstsq(features.cpu(), target.double().cpu()).solution
+    if not torch.isfinite(solution).all():
+        return False
+    with torch.no_grad():
+        n_features = output_layer.in_features
+        output_layer.weight.copy_(solution[:n_features].T)
+        if output_layer.bias is not None:
+            output_layer.bias.copy_(solution[n_features])
+    return True
+
+
+def fit_model(model: torch.nn.Module, grid: torch.Tensor, target: torch.Tensor,
+              time_budget: float = 5., rtol: float = 1e-3, max_points: int = 4096,
+              verbose: bool = False) -> torch.optim.Optimizer:
+    """
+    Fits the model to the target values. The output layer is fitted by the least
+    squares first (see output_layer_fit), then the whole model is fine-tuned by LBFGS
+    on the subset of points until the relative error or the time budget is reached.
+
+    Args:
+        model: model to fit.
+        grid: points where the target is given.
+        target: target values with shape (len(grid), number of outputs).
+        time_budget: maximal fine-tuning time in seconds.
+        rtol: fine-tuning stops if the relative (L2) error is less than rtol.
+        max_points: maximal number of points used for fitting.
+        verbose: prints the fitting error.
+
+    Returns:
+        the optimizer used for fine-tuning.
+    """
+    if len(grid) > max_points:
+        idx = torch.randperm(len(grid))[:max_points]
+        grid, target = grid[idx.to(grid.device)], target[idx.to(target.device)]
+    grid, target = grid.detach(), target.detach()
+    target_norm = torch.linalg.norm(target).clamp_min(1e-12)
+
+    def rel_error():
+        with torch.no_grad():
+            return (torch.linalg.norm(model(grid) - target) / target_norm).item()
+
+    if output_layer_fit(model, grid, target) and verbose:
+        print('Output layer is fitted, relative error={}'.format(rel_error()))
+
+    optimizer = torch.optim.LBFGS(model.parameters(), lr=1, max_iter=20,
+                                  tolerance_grad=1e-12, tolerance_change=1e-14,
+                                  line_search_fn='strong_wolfe')
+    target_scale = torch.mean(target ** 2).clamp_min(1e-12)
+
+    def closure():
+        optimizer.zero_grad()
+        loss = torch.mean((model(grid) - target) ** 2) / target_scale
+        loss.backward()
+        return loss
+
+    start = time.time()
+    error = rel_error()
+    t = 0
+    while error > rtol and time.time() - start < time_budget:
+        optimizer.step(closure)
+        last_error, error = error, rel_error()
+        t += 1
+        if verbose:
+            print('Interpolate from trained model t={}, relative error={}'.format(t, error))
+        # LBFGS is converged or diverged
+        if not np.isfinite(error) or error >= last_error:
+            break
+    return optimizer
+
+
+def atomic_save(obj: Any, path: str):
+    """
+    Saves the object to the temporary file and atomically renames it,
+    so concurrent readers never see partially written files.
+
+    Args:
+        obj: object to save.
+        path: file path.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    os.close(fd)
+    try:
+        try:
+            torch.save(obj, tmp_path)
+        except RuntimeError:
+            torch.save(obj, tmp_path,
+                       _use_new_zipfile_serialization=False)  # cyrrilic in path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def create_random_fn(eps):
     def randomize_params(m):
         if type(m) == torch.nn.Linear or type(m) == torch.nn.Conv2d:
@@ -50,16 +298,516 @@ def remove_all_files(folder):
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
-class CacheUtils:
+def state_bytes(data: Any) -> int:
+    """
+    Args:
+        data: tensor or nested dicts, lists and tuples of tensors.
+
+    Returns:
+        number of bytes of the tensors.
+    """
+    if isinstance(data, torch.Tensor):
+        return data.nelement() * data.element_size()
+    if isinstance(data, dict):
+        return sum(state_bytes(value) for value in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(state_bytes(value) for value in data)
+    return 0
+
+
+class MemoryCache:
+    """
+    In-process LRU tier in front of the cache directory. It keeps loaded
+    checkpoints, the cache index and the directory listing, so repeated lookups
+    in the same process do not read the files again. Every entry is stored with
+    the stamp (modification time and size) of its file and is dropped if the file
+    has changed. The total size of the stored tensors is bounded by max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = 2 ** 28):
+        """
+        Args:
+            max_bytes: maximal size of the stored entries, 0 disables the tier.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def stamp(path: str) -> Union[tuple, None]:
+        """
+        Args:
+            path: file or directory path.
+
+        Returns:
+            (modification time, size) of the path or None if it does not exist.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, key: Any, stamp: tuple) -> Any:
+        """
+        Args:
+            key: entry key.
+            stamp: current stamp of the entry file.
+
+        Returns:
+            stored value or None if it is absent or outdated.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            entry_stamp, value, n_bytes = self.entries[key]
+            if entry_stamp != stamp:
+                del self.entries[key]
+                self.n_bytes -= n_bytes
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key: Any, stamp: tuple, value: Any, n_bytes: int):
+        """
+        Stores the value, the least recently used entries are dropped
+        to fit max_bytes.
+
+        Args:
+            key: entry key.
+            stamp: stamp of the entry file.
+            value: value to store, it should not be changed after.
+            n_bytes: size of the value.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)[2]
+            if self.max_bytes <= 0 or n_bytes > self.max_bytes:
+                return
+            self.entries[key] = (stamp, value, n_bytes)
+            self.n_bytes += n_bytes
+            self.shrink()
+
+    def shrink(self):
+        """
+        Drops the least recently used entries to fit max_bytes, the caller must hold the lock.
+        """
+        while self.entries and (self.n_bytes > self.max_bytes or self.max_bytes <= 0):
+            self.n_bytes -= self.entries.popitem(last=False)[1][2]
+
+    def resize(self, max_bytes: int):
+        """
+        Args:
+            max_bytes: new maximal size of the stored entries, 0 disables the tier.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.shrink()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+
+memory_cache = MemoryCache()
+
+
+class CacheIndex:
+    """
+    JSON-lines manifest of the cache directory. Every saved model appends
+    a record with its metadata, so the cache can be filtered without loading
+    the models themselves. Records also keep the usage statistics used for
+    the eviction (see CacheIndex.evict). The statistics are collected in memory
+    and written on flush_usage, evict and the process exit. Changes of the manifest
+    and the cache directory are made under the file lock, so several solver processes
+    may use the same cache. The manifest is compacted when it has compact_factor
+    times more lines than models.
+    """
+
+    file_name = 'index.jsonl'
+    eviction_policies = ('lru', 'lfu', 'loss')
+    compact_factor = 2
+    # not written usage statistics, {cache_dir: {file: [times selected, last used]}}
+    usage = {}
+    usage_lock = threading.Lock()
+
+    def __init__(self, cache_dir: str):
+        """
+        Args:
+            cache_dir: directory where saved cache in.
+        """
+        self.cache_dir = cache_dir
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.cache_dir, self.file_name)
+
+    @contextmanager
+    def lock(self):
+        """
+        Exclusive lock of the cache directory (not reentrant).
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path + '.lock', 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def write(self, records: list):
+        """
+        Adds the records to the manifest, the caller must hold the lock.
+
+        Args:
+            records: model metadata, record['file'] is the model file name.
+        """
+        with open(self.path, 'a') as index:
+            index.write(''.join(json.dumps(record) + '\n' for record in records))
+
+    def rewrite(self, records: list):
+        """
+        Replaces the manifest by the records, the caller must hold the lock.
+
+        Args:
+            records: model metadata, record['file'] is the model file name.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as index:
+            index.write(''.join(json.dumps(record) + '\n' for record in records))
+        os.replace(tmp_path, self.path)
+
+    def append(self, record: dict):
+        """
+        Adds the record to the manifest.
+
+        Args:
+            record: model metadata, record['file'] is the model file name.
+        """
+        with self.lock():
+            self.write([record])
+
+    def read(self) -> Tuple[dict, int]:
+        """
+        Reads the manifest as is, it is kept in the memory tier until the file is changed.
+
+        Returns:
+            dict with model file names as keys and the latest records as values
+            and the number of the manifest lines.
+        """
+        stamp = memory_cache.stamp(self.path)
+        if stamp is None:
+            return {}, 0
+        manifest = memory_cache.get(('index', self.path), stamp)
+        if manifest is None:
+            records, n_lines = {}, 0
+            with open(self.path) as index:
+                for line in index:
+                    n_lines += 1
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # partially written line
+                        continue
+                    records[record['file']] = record
+            manifest = (records, n_lines)
+            memory_cache.put(('index', self.path), stamp, manifest, stamp[1])
+        return manifest
+
+    def records(self, usage: Union[dict, None] = None) -> dict:
+        """
+        Reads the manifest. The latest record is used if the file is recorded
+        several times, records of the removed files are skipped. The usage
+        statistics which are not written yet are taken into account.
+
+        Args:
+            usage: usage statistics (see take_usage), if None the not written
+                   statistics of the process are used.
+
+        Returns:
+            dict with model file names as keys and records as values.
+        """
+        records = {file: dict(record) for file, record in self.read()[0].items()
+                   if os.path.isfile(os.path.join(self.cache_dir, file))}
+        if usage is None:
+            with self.usage_lock:
+                usage = dict(self.usage.get(os.path.abspath(self.cache_dir), {}))
+        for file, (n_selected, last_used) in usage.items():
+            if file in records:
+                record = records[file]
+                record['n_selected'] = record.get('n_selected', 0) + n_selected
+                record['last_used'] = max(record.get('last_used', record['timestamp']), last_used)
+        return records
+
+    def take_usage(self) -> dict:
+        """
+        Returns:
+            not written usage statistics of the cache directory, they are cleared.
+        """
+        with self.usage_lock:
+            return self.usage.pop(os.path.abspath(self.cache_dir), {})
+
+    def model_files(self) -> list:
+        """
+        Returns:
+            paths of the models in the cache directory.
+        """
+        stamp = memory_cache.stamp(self.cache_dir)
+        if stamp is None:
+            return []
+        files = memory_cache.get(('files', self.cache_dir), stamp)
+        if files is None:
+            files = glob.glob(os.path.join(self.cache_dir, '*.tar'))
+            memory_cache.put(('files', self.cache_dir), stamp, files, 0)
+        return list(files)
+
+    def download(self, storage: CacheStorage, key: str):
+        """
+        Copies the entry of the storage to the cache directory, the data is streamed
+        to the temporary file which is atomically renamed.
+
+        Args:
+            storage: storage of the cached models.
+            key: entry key (the file name).
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in storage.get(key):
+                    file.write(chunk)
+            os.replace(tmp_path, os.path.join(self.cache_dir, key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def pull(self, storage: CacheStorage, accept: Union[Callable[[dict], bool], None] = None) -> list:
+        """
+        Copies the models which are absent in the cache directory from the storage
+        (along with their optimizer files), their records are added to the manifest.
+        The storage is not trusted: only the compact models are copied, the copied
+        files are checked to load as weights only (without unpickling arbitrary
+        objects) and their records are marked as 'remote' (see
+        CachePreprocessing.read_checkpoint).
+
+        Args:
+            storage: storage of the cached models (see cache_storage.CacheStorage).
+            accept: function of the record, only accepted models are copied.
+                    If None, all models are copied.
+
+        Returns:
+            names of the copied files.
+        """
+        entries = storage.list()
+        local = {os.path.basename(path) for path in self.model_files()}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        pulled = []
+        for key, metadata in entries.items():
+            # keys are file names in the cache directory
+            if not key.endswith('.tar') or os.path.basename(key) != key or key in local:
+                continue
+            if not isinstance(metadata, dict) or metadata.get('format') != 'compact':
+                # pickled models are not loaded from the storage
+                continue
+            if accept is not None and not accept(metadata):
+                continue
+            opt_key = os.path.splitext(key)[0] + '.opt'
+            paths = [os.path.join(self.cache_dir, file) for file in (key, opt_key)]
+            try:
+                if opt_key in entries:
+                    self.download(storage, opt_key)
+                self.download(storage, key)
+            except KeyError:
+                # evicted from the storage concurrently
+                continue
+            if not all(self.weights_only(path) for path in paths if os.path.isfile(path)):
+                for path in paths:
+                    if os.path.isfile(path):
+                        os.remove(path)
+                continue
+            size = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+            pulled.append(dict(metadata, file=key, arch=metadata.get('arch'), size=size,
+                               n_selected=0, remote=True))
+        if pulled:
+            with self.lock():
+                self.write(pulled)
+        return [record['file'] for record in pulled]
+
+    @staticmethod
+    def weights_only(path: str) -> bool:
+        """
+        Checks that the file is loaded as weights only (see CachePreprocessing.read_checkpoint),
+        the model file should be of the compact format.
+
+        Args:
+            path: path of the model or optimizer file.
+
+        Returns:
+            True if the file is loaded.
+        """
+        try:
+            checkpoint = torch.load(path, mmap=True, weights_only=True)
+        except (OSError, EOFError, RuntimeError, pickle.UnpicklingError):
+            return False
+        if not isinstance(checkpoint, dict):
+            return False
+        return not path.endswith('.tar') or checkpoint.get('format') == 'compact'
+
+    def select(self, files: list):
+        """
+        Updates the usage statistics of the models chosen as the initial ones.
+        The statistics are kept in memory until flush_usage (or evict).
+
+        Args:
+            files: model file names.
+        """
+        now = datetime.datetime.now().timestamp()
+        with self.usage_lock:
+            usage = self.usage.setdefault(os.path.abspath(self.cache_dir), {})
+            for file in files:
+                n_selected, _ = usage.get(file, (0, now))
+                usage[file] = [n_selected + 1, now]
+
+    def flush_usage(self):
+        """
+        Writes the usage statistics to the manifest. The manifest is compacted
+        to the latest records if it is compact_factor times longer.
+        """
+        if not self.usage.get(os.path.abspath(self.cache_dir)):
+            return
+        with self.lock():
+            usage = self.take_usage()
+            records = self.records(usage)
+            n_lines = self.read()[1]
+            if n_lines + len(usage) > self.compact_factor * max(len(records), 1):
+                self.rewrite(records.values())
+            else:
+                self.write([records[file] for file in usage if file in records])
+
+    @classmethod
+    def flush_all(cls):
+        """
+        Writes the usage statistics of all cache directories.
+        """
+        for cache_dir in list(cls.usage):
+            try:
+                CacheIndex(cache_dir).flush_usage()
+            except OSError:
+                pass
+
+    def evict(self, max_entries: Union[int, None] = None, max_bytes: Union[int, None] = None,
+              policy: str = 'lru', keep: Union[list, None] = None) -> list:
+        """
+        Removes models until the cache fits the budget, the manifest is rewritten
+        to the latest records only.
+
+        Args:
+            max_entries: maximal number of models in the cache.
+            max_bytes: maximal size of the models in the cache.
+            policy: 'lru' (least recently used models are removed first),
+                    'lfu' (least often chosen models are removed first) or
+                    'loss' (models with the largest loss times size are removed first).
+            keep: names of the files which are not removed, e.g. the model just saved
+                  is not chosen yet and would be the first one removed by 'lfu'.
 
-    def __init__(self):
+        Returns:
+            names of the removed files.
+        """
+        if policy not in self.eviction_policies:
+            raise NameError('Eviction policy should be one of {}'.format(self.eviction_policies))
+        with self.lock():
+            # usage statistics are written with the rewritten manifest
+            records = self.records(self.take_usage())
+            # models saved without the index
+            for path in glob.glob(os.path.join(self.cache_dir, '*.tar')):
+                file = os.path.basename(path)
+                if file not in records:
+                    stat = os.stat(path)
+                    records[file] = {'file': file, 'size': stat.st_size, 'loss': None,
+                                     'timestamp': stat.st_mtime}
+
+            def last_used(record):
+                return record.get('last_used', record['timestamp'])
+
+            if policy == 'lru':
+                key = last_used
+            elif policy == 'lfu':
+                key = lambda record: (record.get('n_selected', 0), last_used(record))
+            else:
+                key = lambda record: -np.inf if record['loss'] is None else \
+                    -record['loss'] * record['size']
+
+            keep = set(keep or [])
+            removed = []
+            kept = sorted(records.values(), key=key, reverse=True)
+            pinned = [record for record in kept if record['file'] in keep]
+            kept = [record for record in kept if record['file'] not in keep]
+            total_bytes = sum(record['size'] for record in kept + pinned)
+            while kept and ((max_entries is not None and len(kept) + len(pinned) > max_entries) or
+                            (max_bytes is not None and total_bytes > max_bytes)):
+                record = kept.pop()
+                path = os.path.join(self.cache_dir, record['file'])
+                for path in (path, os.path.splitext(path)[0] + '.opt'):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                total_bytes -= record['size']
+                removed.append(record['file'])
+
+            self.rewrite([record for record in pinned + kept if 'arch' in record])
+        return removed
+
+
+atexit.register(CacheIndex.flush_all)
+
+
+class CacheUtils:
+    # version of the index records, records without it are of version 1:
+    # 'mat' mode models of version 1 are fitted to the solution matrix with scrambled
+    # outputs (see Cache.cache_mat)
+    record_version = 2
+
+    def __init__(self, max_entries: Union[int, None] = None, max_bytes: Union[int, None] = None,
+                 eviction: str = 'lru', weights_dtype: Union[str, None] = None,
+                 save_optimizer: bool = False, storage: Union[CacheStorage, None] = None):
+        """
+        Args:
+            max_entries: maximal number of models in the cache, if None it is not bounded.
+            max_bytes: maximal size of the cache in bytes, if None it is not bounded.
+            eviction: which models are removed if the cache is out of the budget
+                      (see CacheIndex.evict).
+            weights_dtype: 'float16' or 'bfloat16', weights are stored in half precision,
+                           if None they are stored as is.
+            save_optimizer: optimizer (and gradient scaler) state is stored
+                            in the separate file along with the model.
+            storage: shared storage (see cache_storage.CacheStorage), saved models are
+                     put to it as well, so other solver nodes may use them. Models
+                     evicted from the cache directory are removed from it too.
+        """
+        if weights_dtype not in (None, 'float16', 'bfloat16'):
+            raise NameError("weights_dtype should be None, 'float16' or 'bfloat16'")
         try:
             file = __file__
         except:
             file = os.getcwd()
 
         self._cache_dir = os.path.normpath((os.path.join(os.path.dirname(file), '..', 'cache')))
-
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.weights_dtype = weights_dtype
+        self.save_optimizer = save_optimizer
+        self.storage = storage
 
     def get_cache_dir(self):
         return self._cache_dir
@@ -110,76 +858,349 @@ class CacheUtils:
                                     it may lead to wrong cache item choice")
         return operator
 
-    def save_model(self, model: Any, optimizer: Any, scaler: Any = None, name: Union[str, None] = None):
+    @staticmethod
+    def problem_hash(grid: torch.Tensor, operator: Any, bconds: Any) -> str:
+        """
+        Computes the hash of the problem (grid, operator and boundary conditions).
+        Callable coefficients are not distinguished.
+
+        Args:
+            grid: grid of the problem.
+            operator: operator in the input form.
+            bconds: boundary conditions in the input form.
+
+        Returns:
+            hex digest of the hash.
+        """
+
+        def canonical(item):
+            if isinstance(item, torch.Tensor):
+                return PreparedCache.tensor_hash(item)
+            if isinstance(item, dict):
+                return {str(key): canonical(value) for key, value in item.items()}
+            if isinstance(item, (list, tuple)):
+                return [canonical(value) for value in item]
+            if callable(item):
+                return 'callable'
+            return repr(item)
+
+        problem = json.dumps(canonical([operator, bconds]), sort_keys=True)
+        return PreparedCache.tensor_hash(grid, extra=problem)
+
+    @staticmethod
+    def problem_signature(grid: torch.Tensor, operator: Any, bconds: Any, mode: str = 'NN') -> dict:
+        """
+        Computes the compact signature of the problem, it is used to find the cached
+        models of the similar problems (see signature_distance). The signature keeps
+        the structure of the operator terms (derivatives, powers and variables) with
+        the mean coefficients, the domain bounds and the boundary conditions types
+        with their mean values and positions.
+
+        Args:
+            grid: grid of the problem.
+            operator: operator in the input form.
+            bconds: boundary conditions in the input form.
+            mode: solver mode, the grid of 'mat' mode is (dims, n_1, .., n_dims).
+
+        Returns:
+            JSON serializable signature.
+        """
+
+        def mean(value):
+            if callable(value):
+                try:
+                    value = value(grid)
+                except Exception:
+                    return None
+            if isinstance(value, torch.Tensor):
+                return float(value.detach().float().mean()) if value.numel() > 0 else None
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return float(value)
+            return None
+
+        def terms(equation):
+            # term structure: (variable, derivative directions, power) of every factor
+            signature = {}
+            for term in equation.values():
+                dif_dir = [key for key in term.keys() if key not in ('coeff', 'pow', 'var')][0]
+                directions, powers, variables = term[dif_dir], term['pow'], term.get('var', 0)
+                if not isinstance(powers, (list, tuple)):
+                    directions, powers, variables = [directions], [powers], [variables]
+                elif not isinstance(variables, (list, tuple)):
+                    variables = [variables] * len(powers)
+                factors = sorted([int(var), sorted(d for d in direction if d is not None), float(power)]
+                                 for direction, power, var in zip(directions, powers, variables))
+                key = json.dumps(factors)
+                coeff = mean(term['coeff'])
+                if key not in signature:
+                    signature[key] = coeff
+                elif signature[key] is not None and coeff is not None:
+                    signature[key] += coeff
+                else:
+                    signature[key] = None
+            return signature
+
+        def center(bnd):
+            bnd = bnd if isinstance(bnd, (list, tuple)) else [bnd]
+            try:
+                bnd = torch.cat([b.detach().float().reshape(-1, points.shape[1]) for b in bnd])
+            except (RuntimeError, AttributeError):
+                return None
+            return bnd.mean(0).tolist() if len(bnd) > 0 else None
+
+        if mode == 'mat':
+            points = grid.reshape(grid.shape[0], -1).T
+        else:
+            points = grid.reshape(len(grid), -1)
+        points = points.detach().float()
+        operator = operator if isinstance(operator, list) else [operator]
+        boundaries = []
+        for bcond in bconds:
+            if isinstance(bcond, dict):
+                bcond = [bcond['bnd'], bcond['bop'], bcond['bval'], bcond['var'], bcond['type']]
+            bop = [item for item in bcond[1:-1] if isinstance(item, dict)]
+            variables = [item for item in bcond[1:-1] if isinstance(item, int) and not isinstance(item, bool)]
+            values = [item for item in bcond[1:-1] if isinstance(item, torch.Tensor)]
+            boundaries.append({'type': bcond[-1],
+                               'var': variables[0] if variables else 0,
+                               'bop': sorted(terms(bop[0]).keys()) if bop else None,
+                               'value': mean(values[0]) if values else None,
+                               'center': center(bcond[0])})
+        return {'terms': [terms(equation) for equation in operator],
+                'bounds': [points.min(0).values.tolist(), points.max(0).values.tolist()],
+                'bconds': boundaries}
+
+    @staticmethod
+    def signature_distance(first: dict, second: dict) -> float:
+        """
+        Distance between the problems signatures (see problem_signature). Every operator
+        term or boundary condition present in one problem only adds 1, the common ones
+        add the relative difference of the coefficients (values and positions), the domain
+        bounds add their relative shift.
+
+        Args:
+            first: signature of the problem.
+            second: signature of the problem.
+
+        Returns:
+            distance, 0 for the same problems, inf if the dimensions differ.
+        """
+
+        def relative(a, b):
+            if a is None or b is None:
+                return 0. if a is None and b is None else 1.
+            # values close to zero are compared absolutely
+            return abs(a - b) / (abs(a) + abs(b) + 1e-6)
+
+        if len(first['terms']) != len(second['terms']) or \
+                len(first['bounds'][0]) != len(second['bounds'][0]):
+            return np.inf
+        distance = 0.
+        for first_terms, second_terms in zip(first['terms'], second['terms']):
+            for key in set(first_terms) | set(second_terms):
+                if key in first_terms and key in second_terms:
+                    distance += relative(first_terms[key], second_terms[key])
+                else:
+                    distance += 1.
+        extent = [max(high_1, high_2) - min(low_1, low_2) or 1. for low_1, high_1, low_2, high_2 in
+                  zip(first['bounds'][0], first['bounds'][1], second['bounds'][0], second['bounds'][1])]
+        for low_1, high_1, low_2, high_2, size in zip(first['bounds'][0], first['bounds'][1],
+                                                      second['bounds'][0], second['bounds'][1], extent):
+            distance += (abs(low_1 - low_2) + abs(high_1 - high_2)) / size
+
+        def bconds_distance(bconds, others):
+            total = 0.
+            for bcond in bconds:
+                best = 1.
+                for other in others:
+                    if (bcond['type'], bcond['var'], bcond['bop']) != (other['type'], other['var'], other['bop']):
+                        continue
+                    shift = 0. if bcond['center'] is None or other['center'] is None else \
+                        np.mean([abs(a - b) / size for a, b, size in zip(bcond['center'], other['center'], extent)])
+                    best = min(best, shift + relative(bcond['value'], other['value']))
+                total += best
+            return total
+
+        distance += (bconds_distance(first['bconds'], second['bconds']) +
+                     bconds_distance(second['bconds'], first['bconds'])) / 2
+        return float(distance)
+
+    def save_model(self, model: Any, optimizer: Any, scaler: Any = None, name: Union[str, None] = None,
+                   loss: Union[float, None] = None, problem_hash: Union[str, None] = None,
+                   signature: Union[dict, None] = None):
         """
         Saved model in a cache (uses for 'NN' and 'autograd' methods).
+        The model metadata is added to the cache index (see CacheIndex), models are
+        evicted if the cache is out of the budget. The file is written to the temporary
+        file first and atomically renamed, so concurrent lookups never read partially
+        written models.
+
+        If the architecture can be described (see model_descriptor), the compact format
+        is used: the descriptor and weights only (in weights_dtype if it is set), which are
+        loaded memory-mapped without unpickling the model. The optimizer state is stored
+        in the separate '.opt' file only if save_optimizer is set. Otherwise the whole model
+        is pickled.
         Args:
             model: model to save.
-            optimizer: a dict holding current optimization state (i.e., values, hyperparameters).
+            optimizer: a dict holding current optimization state (i.e., values, hyperparameters),
+                       if None the optimizer state is not stored.
             scaler: gradient scaler (uses only with mixed precision and device=cuda).
             name: name for a model.
+            loss: final loss of the model.
+            problem_hash: hash of the solved problem (see CacheUtils.problem_hash).
+            signature: signature of the solved problem (see CacheUtils.problem_signature).
         """
 
         if name == None:
             name = str(datetime.datetime.now().timestamp())
-        if not (os.path.isdir(self.cache_dir)):
-            os.mkdir(self.cache_dir)
-
-        parameters_dict = {'model': model.to('cpu'),
-                           'model_state_dict': model.state_dict(),
-                           'optimizer_state_dict': optimizer.state_dict(),
-                           'scaler_state_dict': scaler.state_dict() if scaler is not None else None}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        file = name + '.tar'
+        path = os.path.join(self.cache_dir, file)
+
+        descriptor = model_descriptor(model)
+        optimizer_dict = {'optimizer_state_dict': optimizer.state_dict() if optimizer is not None else None,
+                          'scaler_state_dict': scaler.state_dict() if scaler is not None else None}
+        opt_path = os.path.splitext(path)[0] + '.opt'
+        if descriptor is not None:
+            dtype = getattr(torch, self.weights_dtype) if self.weights_dtype is not None else None
+            state_dict = {}
+            for key, value in model.state_dict().items():
+                value = value.detach().cpu()
+                if dtype is not None and value.is_floating_point():
+                    value = value.to(dtype)
+                state_dict[key] = value
+            parameters_dict = {'format': 'compact',
+                               'arch': descriptor,
+                               'model_state_dict': state_dict}
+        else:
+            parameters_dict = {'model': model.to('cpu'),
+                               'model_state_dict': model.state_dict(),
+                               **optimizer_dict}
 
         try:
-            torch.save(parameters_dict, self.cache_dir + '\\' + name + '.tar')
-            print('model is saved in cache')
-        except RuntimeError:
-            torch.save(parameters_dict, self.cache_dir + '\\' + name + '.tar',
-                       _use_new_zipfile_serialization=False)  # cyrrilic in path
+            if descriptor is not None and self.save_optimizer and optimizer is not None:
+                atomic_save(optimizer_dict, opt_path)
+            atomic_save(parameters_dict, path)
             print('model is saved in cache')
         except:
             print('Cannot save model in cache')
+            return
+
+        timestamp = datetime.datetime.now().timestamp()
+        index = CacheIndex(self.cache_dir)
+        record = {
+            'file': file,
+            'arch': hashlib.sha256(str(model).encode()).hexdigest(),
+            'in_features': count_input(model),
+            'out_features': count_output(model),
+            'problem_hash': problem_hash,
+            'signature': signature,
+            'loss': loss,
+            'format': 'compact' if descriptor is not None else 'pickle',
+            'size': os.path.getsize(path) + (os.path.getsize(opt_path) if os.path.isfile(opt_path) else 0),
+            'timestamp': timestamp,
+            'last_used': timestamp,
+            'n_selected': 0,
+            'version': self.record_version}
+        index.append(record)
+        if self.storage is not None:
+            self.put(file, record)
+        if self.max_entries is not None or self.max_bytes is not None:
+            # the saved model is never the one removed
+            removed = index.evict(self.max_entries, self.max_bytes, self.eviction, keep=[file])
+            if removed and self.storage is not None:
+                self.evict_storage(removed)
+
+    def put(self, file: str, record: dict):
+        """
+        Puts the saved model (and its optimizer file) to the storage,
+        the storage may buffer it until flush.
+
+        Args:
+            file: model file name.
+            record: model metadata.
+        """
+        opt_file = os.path.splitext(file)[0] + '.opt'
+        try:
+            if os.path.isfile(os.path.join(self.cache_dir, opt_file)):
+                with open(os.path.join(self.cache_dir, opt_file), 'rb') as data:
+                    self.storage.put(opt_file, data.read(), {'file': opt_file})
+            with open(os.path.join(self.cache_dir, file), 'rb') as data:
+                self.storage.put(file, data.read(), record)
+        except (OSError, KeyError):
+            print('Cannot put model to the cache storage')
+
+    def evict_storage(self, files: list):
+        """
+        Removes the models evicted from the cache directory (and their optimizer
+        files) from the storage, so they are not pulled back (see CacheIndex.pull).
+
+        Args:
+            files: model file names.
+        """
+        keys = []
+        for file in files:
+            keys += [file, os.path.splitext(file)[0] + '.opt']
+        try:
+            self.storage.evict(keys)
+        except (OSError, KeyError):
+            print('Cannot evict models from the cache storage')
+
+    def flush(self):
+        """
+        Writes the usage statistics of the cached models and the models buffered by the storage.
+        """
+        CacheIndex(self.cache_dir).flush_usage()
+        if self.storage is None:
+            return
+        try:
+            self.storage.flush()
+        except (OSError, KeyError):
+            print('Cannot put model to the cache storage')
 
-    def save_model_mat(self, model, grid, cache_model: None = None, name: None = None ):
+    def save_model_mat(self, model, grid, cache_model: None = None, name: None = None,
+                       loss: Union[float, None] = None, problem_hash: Union[str, None] = None,
+                       signature: Union[dict, None] = None, time_budget: float = 5., rtol: float = 1e-3, verbose: bool = False):
         """
-        Saved model in a cache (uses for 'mat' method).
+        Saved model in a cache (uses for 'mat' method). The network is fitted
+        to the solution matrix (see fit_model) and saved.
 
         Args:
             cache_dir: a directory where saved cache in.
             name: name for a model
             cache_model: model to save
+            loss: final loss of the model.
+            problem_hash: hash of the solved problem (see CacheUtils.problem_hash).
+            signature: signature of the solved problem (see CacheUtils.problem_signature).
+            time_budget: maximal fitting time in seconds.
+            rtol: fitting stops if the relative (L2) error is less than rtol.
+            verbose: prints the fitting error.
         """
 
         NN_grid, cache_model = self.grid_model_mat(model, grid, cache_model)
-        optimizer = torch.optim.Adam(cache_model.parameters(), lr=0.001)
-        model_res = model.reshape(-1, model.shape[0])
+        NN_grid = check_device(NN_grid)
+        cache_model = cache_model.to(NN_grid.device)
+        # (outputs, n1, ..., nd) -> (points, outputs), points are ordered as in NN_grid
+        model_res = model.detach().reshape(model.shape[0], -1).T.to(NN_grid.device)
 
-        print(NN_grid.shape, model_res.shape)
-        def closure():
-            optimizer.zero_grad()
-            loss = torch.mean((cache_model(check_device(NN_grid)) - model_res) ** 2)
-            loss.backward()
-            return loss
-
-        loss = np.inf
-        t = 0
-        while loss > 1e-5 and t < 1e5:
-            loss = optimizer.step(closure)
-            t += 1
-            print('Interpolate from trained model t={}, loss={}'.format(
-                    t, loss))
+        optimizer = fit_model(cache_model, NN_grid, model_res, time_budget=time_budget,
+                              rtol=rtol, verbose=verbose)
 
-        self.save_model(cache_model, optimizer, name=name)
+        self.save_model(cache_model, optimizer, name=name, loss=loss, problem_hash=problem_hash,
+                        signature=signature)
 
 
 class CachePreprocessing:
-    def __init__(self, grid, equal_cls, model, mode, weak_form, mixed_precision):
+    def __init__(self, grid, equal_cls, model, mode, weak_form, mixed_precision, cache_dir=None,
+                 storage=None):
         self.grid = grid
         self.equal_cls = equal_cls
         self.model = model
         self.mode = mode
         self.weak_form = weak_form
         self.mixed_precision = mixed_precision
+        self.cache_dir = CacheUtils().cache_dir if cache_dir is None else cache_dir
+        self.storage = storage
 
     @staticmethod
     def cache_files(files, nmodels):
@@ -191,10 +1212,261 @@ class CachePreprocessing:
             cache_n = np.arange(len(files))
         else:
             # here we take random nmodels from the cache
-            cache_n = np.random.choice(len(files), nmodels, replace=False)
+            cache_n = np.random.choice(len(files), min(nmodels, len(files)), replace=False)
 
         return cache_n
 
+    @staticmethod
+    def load_checkpoint(file: str, trusted: bool = True) -> dict:
+        """
+        Loads the cached model, the file is memory-mapped if possible.
+        Compact files (see CacheUtils.save_model) are loaded as weights only,
+        the model is rebuilt from the descriptor and the optimizer state is not
+        loaded, its file is given as checkpoint['optimizer_file'] (see load_optimizer_state).
+        Loaded checkpoints are kept in memory (see MemoryCache) as they are read,
+        the weights are copied once to the new model at every call.
+
+        Args:
+            file: path of the model file.
+            trusted: if False, the file is loaded as weights only (see read_checkpoint).
+
+        Returns:
+            checkpoint with the model state loaded.
+        """
+        stamp = memory_cache.stamp(file)
+        checkpoint = memory_cache.get(('model', file), stamp)
+        if checkpoint is None:
+            checkpoint = CachePreprocessing.read_checkpoint(file, trusted)
+            memory_cache.put(('model', file), stamp, checkpoint,
+                             state_bytes(checkpoint['model_state_dict']) +
+                             state_bytes(checkpoint['optimizer_state_dict']))
+        if checkpoint['arch'] is not None:
+            model = model_from_descriptor(checkpoint['arch'])
+            model.load_state_dict(checkpoint['model_state_dict'])
+        else:
+            model = deepcopy(checkpoint['model'])
+        return {'model': model,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': checkpoint['optimizer_state_dict'],
+                'optimizer_file': checkpoint['optimizer_file']}
+
+    @staticmethod
+    def read_checkpoint(file: str, trusted: bool = True) -> dict:
+        """
+        Reads the cached model from the file (see load_checkpoint). The tensors
+        are not copied, so they stay memory-mapped and should not be changed.
+        Unpickling runs arbitrary code, so the models pickled as a whole (saved
+        before the compact format) are loaded from the trusted files only.
+
+        Args:
+            file: path of the model file.
+            trusted: if False (e.g. the model is pulled from the storage, see
+                     CacheIndex.pull), the file is loaded as weights only.
+
+        Returns:
+            checkpoint with the model descriptor ('arch') and the state dict
+            for the compact format or the model with the state loaded otherwise.
+        """
+        try:
+            checkpoint = torch.load(file, mmap=True, weights_only=True)
+        except (RuntimeError, pickle.UnpicklingError):
+            if not trusted:
+                raise
+            try:
+                checkpoint = torch.load(file, mmap=True, weights_only=False)
+            except RuntimeError:
+                # legacy (not zip) serialization can not be memory-mapped
+                checkpoint = torch.load(file, weights_only=False)
+        if checkpoint.get('format') == 'compact':
+            opt_file = os.path.splitext(file)[0] + '.opt'
+            return {'arch': checkpoint['arch'],
+                    'model': None,
+                    'model_state_dict': checkpoint['model_state_dict'],
+                    'optimizer_state_dict': None,
+                    'optimizer_file': opt_file if os.path.isfile(opt_file) else None}
+        model = checkpoint['model']
+        model_state = model.state_dict()
+        # the state is usually saved with the model itself and shares its storage
+        if any(model_state[key].data_ptr() != value.data_ptr()
+               for key, value in checkpoint['model_state_dict'].items() if key in model_state):
+            model.load_state_dict(checkpoint['model_state_dict'])
+        return {'arch': None,
+                'model': model,
+                'model_state_dict': model.state_dict(),
+                'optimizer_state_dict': checkpoint.get('optimizer_state_dict'),
+                'optimizer_file': None}
+
+    @staticmethod
+    def load_optimizer_state(checkpoint: dict) -> Union[dict, None]:
+        """
+        Returns the optimizer state of the cached model, it is loaded from the
+        separate file (as weights only) for the compact format.
+
+        Args:
+            checkpoint: checkpoint (see load_checkpoint).
+
+        Returns:
+            optimizer state dict or None if it is not stored.
+        """
+        if checkpoint.get('optimizer_state_dict') is None and checkpoint.get('optimizer_file'):
+            checkpoint['optimizer_state_dict'] = torch.load(
+                checkpoint['optimizer_file'], weights_only=True)['optimizer_state_dict']
+        return checkpoint.get('optimizer_state_dict')
+
+    def load_checkpoints(self, files: list, n_workers: Union[int, None] = None,
+                         trusted: Union[Callable[[str], bool], None] = None):
+        """
+        Loads the cached models in the thread pool. Not more than n_workers
+        models are loaded ahead of the consumer, so the memory is bounded.
+
+        Args:
+            files: paths of the model files.
+            n_workers: number of loading threads, if None os.cpu_count() (up to 8) is used.
+            trusted: function of the file path, the files which are not trusted are
+                     loaded as weights only (see read_checkpoint). If None, all files
+                     are trusted.
+
+        Returns:
+            generator of the checkpoints in the files order, None for the files
+            which can not be read (e.g. evicted by another process or corrupt).
+        """
+        if n_workers is None:
+            n_workers = min(8, os.cpu_count() or 1)
+        if n_workers <= 1:
+            for file in files:
+                yield self.try_load_checkpoint(file, trusted is None or trusted(file))
+            return
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            pending = deque()
+            for file in files:
+                pending.append(pool.submit(self.try_load_checkpoint, file,
+                                           trusted is None or trusted(file)))
+                if len(pending) > n_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    @staticmethod
+    def try_load_checkpoint(file: str, trusted: bool = True) -> Union[dict, None]:
+        """
+        Loads the cached model (see load_checkpoint).
+
+        Args:
+            file: path of the model file.
+            trusted: if False, the file is loaded as weights only.
+
+        Returns:
+            checkpoint or None if the file is missing or corrupt.
+        """
+        try:
+            return CachePreprocessing.load_checkpoint(file, trusted)
+        except (OSError, EOFError, RuntimeError, KeyError, ValueError, pickle.UnpicklingError):
+            return None
+
+    def models_loss(self, models: list, lambda_operator: float, lambda_bound: float,
+                    solutions: dict, save_graph: bool = False,
+                    batch_size: Union[int, None] = None) -> list:
+        """
+        Computes the loss of several models with the same architecture.
+        Models are stacked to the Ensemble and evaluated at once, if the loss allows it.
+        If the models can not be stacked or vectorized (e.g. the layers are not supported
+        by torch.func.vmap), they are evaluated one by one.
+
+        Args:
+            models: models with the same architecture.
+            lambda_operator: coeff for operator part in loss.
+            lambda_bound: coeff for boundary part in loss.
+            solutions: prepared problems (Solution) by the number of models and batch size,
+                       they are reused between the calls.
+            save_graph: boolean constant, responsible for saving the computational graph.
+            batch_size: if not None, the loss is computed on the subset of collocation
+                        and boundary points of this size. The subset is the same for
+                        every call, so the losses of different models are comparable.
+
+        Returns:
+            list of (loss, normalized loss) for every model.
+        """
+        if len(models) > 1:
+            if (self.weak_form is None or self.weak_form == []) and \
+                    not solutions.get('sequential', False):
+                try:
+                    return self.evaluate_models(Ensemble(models), len(models), lambda_operator,
+                                                lambda_bound, solutions, save_graph, batch_size)
+                except (RuntimeError, NotImplementedError, ValueError, TypeError):
+                    # the prepared problem may be left in the inconsistent state,
+                    # the models are not stacked in the next calls
+                    solutions.pop((len(models), batch_size), None)
+                    solutions['sequential'] = True
+            return [loss for model in models
+                    for loss in self.models_loss([model], lambda_operator, lambda_bound,
+                                                 solutions, save_graph, batch_size)]
+        return self.evaluate_models(models[0].to(device_type()), 1, lambda_operator,
+                                    lambda_bound, solutions, save_graph, batch_size)
+
+    def evaluate_models(self, model: Any, n_models: int, lambda_operator: float, lambda_bound: float,
+                        solutions: dict, save_graph: bool = False,
+                        batch_size: Union[int, None] = None) -> list:
+        """
+        Computes the loss of the model or the models stacked to the Ensemble (see models_loss).
+
+        Args:
+            model: model or models.Ensemble.
+            n_models: number of the stacked models.
+            lambda_operator: coeff for operator part in loss.
+            lambda_bound: coeff for boundary part in loss.
+            solutions: prepared problems (Solution) by the number of models and batch size.
+            save_graph: boolean constant, responsible for saving the computational graph.
+            batch_size: size of the points subset (see models_loss).
+
+        Returns:
+            list of (loss, normalized loss) for every model, the losses are detached
+            unless save_graph is True.
+        """
+        sln_cls = self.prepared_solution(model, n_models, lambda_operator, lambda_bound,
+                                         solutions, batch_size)
+        if batch_size is None:
+            loss, loss_normalized = sln_cls.evaluate(save_graph=save_graph)
+        else:
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(0)
+                loss, loss_normalized = sln_cls.evaluate(save_graph=save_graph)
+        if n_models > 1:
+            return list(zip(sln_cls.member_loss, sln_cls.member_loss_normalized))
+        if not save_graph:
+            # causal and weak losses keep the graph regardless of save_graph
+            loss, loss_normalized = loss.detach(), loss_normalized.detach()
+        return [(loss, loss_normalized)]
+
+    def prepared_solution(self, model: Any, n_models: int, lambda_operator: float,
+                          lambda_bound: float, solutions: dict,
+                          batch_size: Union[int, None] = None) -> Solution:
+        """
+        Returns the prepared problem for the number of models and batch size
+        with the model set, the problem is prepared once (see Solution.set_model).
+
+        Args:
+            model: model or models.Ensemble.
+            n_models: number of the stacked models.
+            lambda_operator: coeff for operator part in loss.
+            lambda_bound: coeff for boundary part in loss.
+            solutions: prepared problems (Solution) by the number of models and batch size.
+            batch_size: size of the points subset (see models_loss).
+
+        Returns:
+            prepared problem.
+        """
+        key = (n_models, batch_size)
+        if key not in solutions:
+            solutions[key] = Solution(self.grid, self.equal_cls,
+                                      model, self.mode, self.weak_form,
+                                      lambda_operator, lambda_bound, tol=0,
+                                      derivative_points=2, batch_size=batch_size,
+                                      bnd_batch_size=batch_size,
+                                      stratified_batch=self.mode == 'autograd')
+        else:
+            solutions[key].set_model(model)
+        return solutions[key]
+
     @staticmethod
     def model_reform(init_model, model):
         """
@@ -223,40 +1495,140 @@ class CachePreprocessing:
 
     def cache_lookup(self, lambda_operator: float = 1., lambda_bound: float = 0.001,
                      nmodels: Union[int, None] = None, save_graph: bool = False,
-                     cache_verbose: bool = False, return_normalized_loss: bool = False) -> Union[None, dict, torch.Tensor]:
+                     cache_verbose: bool = False, return_normalized_loss: bool = False,
+                     n_workers: Union[int, None] = None, eval_batch: int = 16,
+                     screen_points: Union[int, None] = None, top_k: int = 3,
+                     n_best: int = 1, n_nearest: Union[int, None] = None,
+                     solutions: Union[dict, None] = None,
+                     accept: Union[Callable[[Union[dict, None]], bool], None] = None) -> Union[None, dict, list]:
         """
-        Looking for a saved cache.
+        Looking for a saved cache. Models which input and output sizes differ
+        from the solver model are skipped using the cache index (see CacheIndex),
+        so they are not loaded. If the shared storage is set, its models which are
+        absent in the cache directory are copied first (see CacheIndex.pull).
+
+        If screen_points is given, the lookup is two-stage: all models are screened
+        on the fixed subset of collocation and boundary points, and only top_k of them
+        are evaluated on the whole problem. So the whole cache may be looked at
+        (nmodels=None).
+
+        If n_nearest is given, only the models of the problems nearest to the current
+        one by the signature (see CacheUtils.signature_distance) are loaded and evaluated,
+        the signatures are taken from the index, so the other models are not loaded.
         Args:
             lambda_bound: an arbitrary chosen constant, influence only convergence speed.
             save_graph: boolean constant, responsible for saving the computational graph.
             cache_dir: directory where saved cache in.
             nmodels: maximal number of models that are looked before optimization
             cache_verbose: more detailed info about models in cache.
+            n_workers: number of threads loading the cached models (see load_checkpoints),
+                       models are evaluated while the next ones are loaded.
+            eval_batch: number of models with the same architecture evaluated at once
+                        (see models_loss).
+            screen_points: number of points (per boundary condition for the boundary)
+                           used for screening, if None the screening is not used.
+                           Screening is not available with the weak form.
+            top_k: number of the best screened models evaluated on the whole problem.
+            n_best: number of the best models returned.
+            n_nearest: number of the models of the nearest problems evaluated,
+                       if None all models are evaluated. Models saved without
+                       the signature are the farthest.
+            solutions: prepared problems (see models_loss), they are filled and may be
+                       reused after the lookup (e.g. by Cache.cache_race).
+            accept: function of the index record (None for the models saved without
+                    the index), only accepted models are evaluated. If None, all models
+                    with the same input and output sizes are evaluated.
         Returns:
-            * **best_checkpoint** -- best model with optimizator state.\n
+            * **best_checkpoint** -- best model with optimizator state
+              (list of n_best checkpoints sorted by loss if n_best > 1).\n
             * **min_loss** -- minimum error in pre-trained error.
         """
 
-        files = glob.glob(CacheUtils().cache_dir + '\*.tar')
+        index = CacheIndex(self.cache_dir)
+        in_features, out_features = count_input(self.model), count_output(self.model)
+        if self.storage is not None:
+            try:
+                index.pull(self.storage, lambda record: record.get('in_features') == in_features and
+                                                        record.get('out_features') == out_features)
+            except OSError:
+                print('Cannot reach the cache storage')
+        files = index.model_files()
+        records = index.records()
+        files = [file for file in files
+                 if os.path.basename(file) not in records or
+                 (records[os.path.basename(file)]['in_features'] == in_features and
+                  records[os.path.basename(file)]['out_features'] == out_features)]
+        if accept is not None:
+            files = [file for file in files if accept(records.get(os.path.basename(file)))]
         if len(files) == 0:
             best_checkpoint = None
             min_loss = torch.tensor([float('inf')])
             return best_checkpoint
 
+        if n_nearest is not None and len(files) > n_nearest:
+            signature = CacheUtils.problem_signature(self.grid, self.equal_cls.operator,
+                                                     self.equal_cls.bconds, self.mode)
+
+            def distance(file):
+                record = records.get(os.path.basename(file))
+                if record is None or record.get('signature') is None:
+                    return np.inf
+                return CacheUtils.signature_distance(signature, record['signature'])
+
+            distances = [distance(file) for file in files]
+            files = [files[i] for i in np.argsort(distances, kind='stable')[:n_nearest]]
+            if cache_verbose:
+                print('nearest problems distances: {}'.format(sorted(distances)[:n_nearest]))
+
         cache_n = self.cache_files(files, nmodels)
 
-        min_loss = np.inf
-        min_norm_loss = np.inf
-        best_checkpoint = {}
+        # the best models as (loss, normalized loss, file, checkpoint) sorted by loss
+        best = []
+        # the problem is prepared once, cached models are swapped in it
+        solutions = {} if solutions is None else solutions
+        # models waiting for evaluation by architecture
+        groups = {}
+        screening = screen_points is not None and (self.weak_form is None or self.weak_form == [])
+        # the best screened models
+        screened = []
 
         device = device_type()
 
-        for i in cache_n:
-            file = files[i]
-            checkpoint = torch.load(file)
-
+        def evaluate_group(group, screen=screening):
+            if screen:
+                losses = self.models_loss([model for _, model, _ in group], lambda_operator,
+                                          lambda_bound, solutions, batch_size=screen_points)
+                screened.extend((float(loss), candidate) for candidate, (loss, _) in zip(group, losses))
+                screened.sort(key=lambda item: item[0])
+                del screened[max(top_k, n_best):]
+                return
+            losses = self.models_loss([model for _, model, _ in group], lambda_operator,
+                                      lambda_bound, solutions, save_graph=save_graph)
+            for (i, model, checkpoint), (loss, loss_normalized) in zip(group, losses):
+                if len(best) == n_best and loss >= best[-1][0]:
+                    continue
+                if cache_verbose and (len(best) == 0 or loss < best[0][0]):
+                    print('best_model_num={} , normalized_loss={}'.format(i, loss_normalized.item()))
+                model = model.to(device)
+                best.append((loss, loss_normalized, files[i],
+                             {'model': model,
+                              'model_state_dict': model.state_dict(),
+                              'optimizer_state_dict': checkpoint['optimizer_state_dict'],
+                              'optimizer_file': checkpoint.get('optimizer_file')}))
+                best.sort(key=lambda item: float(item[0]))
+                del best[n_best:]
+
+        # the models pulled from the storage are not unpickled
+        checkpoints = self.load_checkpoints(
+            [files[i] for i in cache_n], n_workers,
+            lambda file: not (records.get(os.path.basename(file)) or {}).get('remote', False))
+
+        for i, checkpoint in zip(cache_n, checkpoints):
+            if checkpoint is None:
+                if cache_verbose:
+                    print('{} can not be loaded, it is skipped'.format(files[i]))
+                continue
             model = checkpoint['model']
-            model.load_state_dict(checkpoint['model_state_dict'])
 
             # this one for the input shape fix if needed
 
@@ -270,69 +1642,67 @@ class CachePreprocessing:
             except Exception:
                 continue
 
-            model = model.to(device)
-            loss, loss_normalized = Solution(self.grid, self.equal_cls,
-                                             model, self.mode, self.weak_form,
-                                             lambda_operator, lambda_bound, tol=0,
-                                             derivative_points=2).evaluate(save_graph=save_graph)
-
-            if loss < min_loss:
-                min_loss = loss
-                min_norm_loss = loss_normalized
-                best_checkpoint['model'] = model
-                best_checkpoint['model_state_dict'] = model.state_dict()
-                best_checkpoint['optimizer_state_dict'] = \
-                    checkpoint['optimizer_state_dict']
-                if cache_verbose:
-                    print('best_model_num={} , normalized_loss={}'.format(i, min_norm_loss.item()))
-
-        if best_checkpoint == {}:
-            best_checkpoint = None
-            min_loss = np.inf
-        if return_normalized_loss:
-            min_loss = min_norm_loss
-        return best_checkpoint
-
-    def scheme_interp(self, trained_model: Any, cache_verbose: bool = False) -> Tuple[Any, dict]:
+            arch = (type(model), str(model))
+            groups.setdefault(arch, []).append((i, model, checkpoint))
+            if len(groups[arch]) >= eval_batch:
+                evaluate_group(groups.pop(arch))
+
+        for group in groups.values():
+            evaluate_group(group)
+
+        if screening:
+            groups = {}
+            for _, (i, model, checkpoint) in screened:
+                groups.setdefault((type(model), str(model)), []).append((i, model, checkpoint))
+            for group in groups.values():
+                evaluate_group(group, screen=False)
+
+        if len(best) == 0:
+            return None
+        CacheIndex(self.cache_dir).select([os.path.basename(file) for _, _, file, _ in best])
+        if n_best > 1:
+            return [checkpoint for _, _, _, checkpoint in best]
+        return best[0][3]
+
+    def scheme_interp(self, trained_model: Any, cache_verbose: bool = False,
+                      model: Any = None, time_budget: float = 5., rtol: float = 1e-3,
+                      max_points: int = 4096) -> Tuple[Any, dict]:
         """
-        Smth
+        Trains the model to imitate the trained (cached) model with another
+        architecture (see fit_model).
 
         Args:
-            trained_model: smth
+            trained_model: model which output is imitated.
             cache_verbose: detailed info about models in cache.
+            model: model trained to imitate trained_model, if None the solver model is used.
+            time_budget: maximal fine-tuning time in seconds.
+            rtol: fine-tuning stops if the relative (L2) error is less than rtol.
+            max_points: maximal number of grid points used for fitting.
         Returns:
             * **model**  -- NN or mat.\n
             * **optimizer_state** -- dict.
         """
-        optimizer = torch.optim.Adam(self.model.parameters(), lr=0.001)
-
-        loss = torch.mean(torch.square(
-            trained_model(self.grid) - self.model(self.grid)))
-
-        def closure():
-            optimizer.zero_grad()
-            loss = torch.mean((trained_model(self.grid) - self.model(self.grid)) ** 2)
-            loss.backward()
-            return loss
-
-        t = 0
-        while loss > 1e-5 and t < 1e5:
-            optimizer.step(closure)
-            loss = torch.mean(torch.square(
-                trained_model(self.grid) - self.model(self.grid)))
-            t += 1
-            if cache_verbose:
-                print('Interpolate from trained model t={}, loss={}'.format(
-                    t, loss))
-
-        return self.model, optimizer.state_dict()
-
-    def cache_retrain(self, cache_checkpoint, cache_verbose: bool = False) -> Tuple[Any, None]:
+        if model is None:
+            model = self.model
+        grid = self.grid
+        if len(grid) > max_points:
+            grid = grid[torch.randperm(len(grid))[:max_points].to(grid.device)]
+        grid = grid.detach()
+        with torch.no_grad():
+            target = trained_model(grid).detach()
+        optimizer = fit_model(model, grid, target, time_budget=time_budget, rtol=rtol,
+                              max_points=max_points, verbose=cache_verbose)
+        return model, optimizer.state_dict()
+
+    def cache_retrain(self, cache_checkpoint, cache_verbose: bool = False,
+                      model: Any = None) -> Tuple[Any, None]:
         """
         Smth
         Args:
             cache_checkpoint: smth
             cache_verbose: detailed info about models in cache.
+            model: model retrained if the cached model has another structure,
+                   if None the solver model is used.
         Returns:
             * **model** -- model.\n
             * **optimizer_state** -- smth
@@ -340,7 +1710,7 @@ class CachePreprocessing:
 
         # do nothing if cache is empty
         if cache_checkpoint == None:
-            return self.model
+            return self.model if model is None else model
         # if models have the same structure use the cache model state,
         # and the cache model has ordinary structure
         if str(cache_checkpoint['model']) == str(self.model) and \
@@ -359,7 +1729,7 @@ class CachePreprocessing:
             cache_model.load_state_dict(cache_checkpoint['model_state_dict'])
             cache_model.eval()
             model, optimizer_state = self.scheme_interp(
-                cache_model, cache_verbose=cache_verbose)
+                cache_model, cache_verbose=cache_verbose, model=model)
         return model
 
 
@@ -371,18 +1741,27 @@ class Cache():
     If there isn't pre-trained model in cache, the training process will start from the beginning.
     """
 
-    def __init__(self, grid, equal_cls, model, mode, weak_form, mixed_precision):
+    def __init__(self, grid, equal_cls, model, mode, weak_form, mixed_precision, cache_dir=None,
+                 storage=None):
         self.grid = grid
         self.equal_cls = equal_cls
         self.model = model
         self.mode = mode
         self.weak_form = weak_form
         self.mixed_precision = mixed_precision
-        self.cache_preprocessing = CachePreprocessing(grid, equal_cls, model, mode, weak_form, mixed_precision)
+        self.cache_dir = cache_dir
+        self.storage = storage
+        self.cache_preprocessing = CachePreprocessing(grid, equal_cls, model, mode, weak_form, mixed_precision,
+                                                      cache_dir=cache_dir, storage=storage)
+        # optimizer state of the cached model if it is used as is (see cache_nn)
+        self.optimizer_state = None
 
     def cache_nn(self, nmodels: Union[int, None], lambda_operator: float, lambda_bound: float,
                  cache_verbose: bool, model_randomize_parameter: Union[float, None],
-                 cache_model: torch.nn.Sequential, return_normalized_loss: bool = False):
+                 cache_model: torch.nn.Sequential, return_normalized_loss: bool = False,
+                 n_workers: Union[int, None] = None, screen_points: Union[int, None] = None,
+                 top_k: int = 3, race: Union[int, None] = None, race_steps: int = 100,
+                 learning_rate: float = 1e-3, n_nearest: Union[int, None] = None):
         """
        Restores the model from the cache and uses it for retraining.
        Args:
@@ -393,26 +1772,168 @@ class Cache():
            model_randomize_parameter:  Creates a random model parameters (weights, biases) multiplied with a given
                                        randomize parameter.
            cache_model: cached model
+           n_workers: number of threads loading the cached models.
+           screen_points: number of points used for the cache screening (see cache_lookup).
+           top_k: number of the best screened models evaluated on the whole problem.
+           race: if given, this number of the best cached models are raced (see cache_race),
+                 otherwise the model with the lowest loss is used.
+           race_steps: training steps of the first race round.
+           learning_rate: learning rate used in the race.
+           n_nearest: number of the models of the nearest problems evaluated (see cache_lookup).
        Returns:
            * **model** -- NN.\n
            * **min_loss** -- min loss as is.
        """
         r = create_random_fn(model_randomize_parameter)
+        # Ensemble is not available with the weak form
+        race = race if self.weak_form is None or self.weak_form == [] else None
+        # prepared problems are shared by the lookup and the race
+        solutions = {}
 
         cache_checkpoint = self.cache_preprocessing.cache_lookup(nmodels=nmodels,
                                                                  cache_verbose=cache_verbose,
                                                                  lambda_operator=lambda_operator,
                                                                  lambda_bound=lambda_bound,
-                                                                 return_normalized_loss=return_normalized_loss)
+                                                                 return_normalized_loss=return_normalized_loss,
+                                                                 n_workers=n_workers,
+                                                                 screen_points=screen_points,
+                                                                 top_k=top_k,
+                                                                 n_best=race if race else 1,
+                                                                 n_nearest=n_nearest,
+                                                                 solutions=solutions)
         # print(cache_checkpoint)
-        model = self.cache_preprocessing.cache_retrain(cache_checkpoint, cache_verbose=cache_verbose)
+        if race and cache_checkpoint is not None:
+            models = [self.cache_preprocessing.cache_retrain(checkpoint, cache_verbose=cache_verbose,
+                                                             model=deepcopy(self.model))
+                      for checkpoint in cache_checkpoint]
+            model = self.cache_race(models, lambda_operator, lambda_bound, race_steps,
+                                    learning_rate, cache_verbose=cache_verbose,
+                                    solutions=solutions)
+        else:
+            model = self.cache_preprocessing.cache_retrain(cache_checkpoint, cache_verbose=cache_verbose)
+            # the optimizer state is valid for the cached weights only
+            if cache_checkpoint is not None and model is cache_checkpoint['model'] and \
+                    not model_randomize_parameter:
+                try:
+                    self.optimizer_state = CachePreprocessing.load_optimizer_state(cache_checkpoint)
+                except (OSError, EOFError, RuntimeError, KeyError, pickle.UnpicklingError):
+                    self.optimizer_state = None
         model.apply(r)
 
         return model
 
+    def load_optimizer(self, optimizer: torch.optim.Optimizer) -> bool:
+        """
+        Restores the optimizer state (e.g. Adam moments) of the cached model used
+        as the initial model. The hyperparameters of the optimizer (e.g. learning rate)
+        are kept. The state is not loaded if it is not stored or was saved by
+        another optimizer.
+
+        Args:
+            optimizer: optimizer of the initial model.
+
+        Returns:
+            True if the state is loaded.
+        """
+        state = self.optimizer_state
+        if state is None or len(state['param_groups']) != len(optimizer.param_groups) or \
+                any(set(saved) != set(group) for saved, group in
+                    zip(state['param_groups'], optimizer.param_groups)):
+            return False
+        hyperparameters = [{key: value for key, value in group.items() if key != 'params'}
+                           for group in optimizer.param_groups]
+        try:
+            optimizer.load_state_dict(state)
+        except (ValueError, KeyError):
+            return False
+        for group, saved in zip(optimizer.param_groups, hyperparameters):
+            group.update(saved)
+        return True
+
+    def cache_race(self, models: list, lambda_operator: float, lambda_bound: float,
+                   race_steps: int, learning_rate: float, cache_verbose: bool = False,
+                   solutions: Union[dict, None] = None) -> torch.nn.Module:
+        """
+        Successive halving race between the warm start candidates. Candidates are
+        trained at once as models.Ensemble for race_steps, the worse half is dropped
+        and the number of steps is doubled until one model is left. So the candidate
+        which converges faster is chosen, not the one with the lowest initial loss.
+        Candidates are raced in one process rather than in a pool of workers: the
+        prepared problem is shared, the models are not copied between processes
+        and one vectorized pass trains all of them. If the models can not be
+        stacked (see CachePreprocessing.models_loss), they are trained one by one.
+
+        Args:
+            models: candidates with the same architecture.
+            lambda_operator: coeff for operator part in loss.
+            lambda_bound: coeff for boundary part in loss.
+            race_steps: training steps of the first round.
+            learning_rate: learning rate of the Adam optimizer.
+            cache_verbose: more detailed info about the race.
+            solutions: prepared problems by the number of models (see
+                       CachePreprocessing.models_loss), they are reused.
+
+        Returns:
+            the best trained model.
+        """
+        solutions = {} if solutions is None else solutions
+        steps = race_steps
+        while len(models) > 1:
+            if solutions.get('sequential', False):
+                member_loss = torch.cat([self.race_train(model, 1, lambda_operator, lambda_bound,
+                                                         steps, learning_rate, solutions)
+                                         for model in models])
+                members = models
+            else:
+                ensemble = Ensemble(models)
+                member_loss = self.race_train(ensemble, len(models), lambda_operator, lambda_bound,
+                                              steps, learning_rate, solutions)
+                members = ensemble.members()
+            member_loss = torch.nan_to_num(member_loss, nan=float('inf'))
+            order = torch.argsort(member_loss)
+            models = [members[i] for i in order[:(len(models) + 1) // 2]]
+            if cache_verbose:
+                print('race: {} models left after {} steps, best loss={}'.format(
+                    len(models), steps, member_loss[order[0]].item()))
+            steps *= 2
+        return models[0]
+
+    def race_train(self, model: Any, n_models: int, lambda_operator: float, lambda_bound: float,
+                   steps: int, learning_rate: float, solutions: dict) -> torch.Tensor:
+        """
+        Trains the race candidate (or the candidates stacked to the Ensemble)
+        with the Adam optimizer (see cache_race).
+
+        Args:
+            model: model or models.Ensemble.
+            n_models: number of the stacked models.
+            lambda_operator: coeff for operator part in loss.
+            lambda_bound: coeff for boundary part in loss.
+            steps: training steps.
+            learning_rate: learning rate of the Adam optimizer.
+            solutions: prepared problems by the number of models.
+
+        Returns:
+            losses of the trained models.
+        """
+        sln_cls = self.cache_preprocessing.prepared_solution(model, n_models, lambda_operator,
+                                                             lambda_bound, solutions)
+        optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+        for _ in range(steps):
+            optimizer.zero_grad()
+            loss, _ = sln_cls.evaluate()
+            loss.backward()
+            optimizer.step()
+        loss, _ = sln_cls.evaluate(save_graph=False)
+        if n_models > 1:
+            return sln_cls.member_loss.detach().cpu()
+        return loss.detach().cpu().reshape(1)
+
     def cache_mat(self, nmodels: Union[int, None], lambda_operator: float, lambda_bound: float,
                   cache_verbose: bool, model_randomize_parameter: Union[float, None],
-                  cache_model: torch.nn.Sequential, return_normalized_loss: bool = False):
+                  cache_model: torch.nn.Sequential, return_normalized_loss: bool = False,
+                  n_workers: Union[int, None] = None, screen_points: Union[int, None] = None,
+                  top_k: int = 3, n_nearest: Union[int, None] = None):
         """
        Restores the model from the cache and uses it for retraining.
        Args:
@@ -423,26 +1944,43 @@ class Cache():
            model_randomize_parameter:  Creates a random model parameters (weights, biases) multiplied with a given
                                        randomize parameter.
            cache_model: cached model
+           n_workers: number of threads loading the cached models.
+           screen_points: number of points used for the cache screening (see cache_lookup).
+           top_k: number of the best screened models evaluated on the whole problem.
+           n_nearest: number of the models of the nearest problems evaluated (see cache_lookup).
        Returns:
            * **model** -- mat.\n
            * **min_loss** -- min loss as is.
        """
 
         NN_grid, cache_model = CacheUtils.grid_model_mat(self.model, self.grid, cache_model)
+        n_outputs = self.model.shape[0]
+
+        def accept(record):
+            # outputs of the multi-output models of version 1 may be scrambled
+            return n_outputs == 1 or (record is not None and
+                                      record.get('version', 1) >= CacheUtils.record_version)
+
         operator = deepcopy(self.equal_cls.operator)
         bconds = deepcopy(self.equal_cls.bconds)
         operator = CacheUtils.mat_op_coeff(operator)
         r = create_random_fn(model_randomize_parameter)
         eq = Equation(NN_grid, operator, bconds).set_strategy('autograd')
         model_cls = CachePreprocessing(NN_grid, eq, cache_model, 'autograd', self.weak_form,
-                                       self.mixed_precision)
+                                       self.mixed_precision, cache_dir=self.cache_dir,
+                                       storage=self.storage)
 
         cache_checkpoint = model_cls.cache_lookup(
             nmodels=nmodels,
             cache_verbose=cache_verbose,
             lambda_bound=lambda_bound,
             lambda_operator=lambda_operator,
-            return_normalized_loss=return_normalized_loss)
+            return_normalized_loss=return_normalized_loss,
+            n_workers=n_workers,
+            screen_points=screen_points,
+            top_k=top_k,
+            n_nearest=n_nearest,
+            accept=accept)
 
         if cache_checkpoint is not None:
             prepared_model = model_cls.cache_retrain(
@@ -451,7 +1989,7 @@ class Cache():
 
             prepared_model.apply(r)
 
-            model = prepared_model(NN_grid).reshape(
+            model = prepared_model(NN_grid).T.reshape(
                 self.cache_preprocessing.model.shape).detach()
 
             min_loss, _ = Solution(self.cache_preprocessing.grid, self.cache_preprocessing.equal_cls,
@@ -466,7 +2004,10 @@ class Cache():
     def cache(self, nmodels: Union[int, None], lambda_operator, lambda_bound: float,
               cache_verbose: bool, model_randomize_parameter: Union[float, None],
               cache_model: torch.nn.Sequential,
-              return_normalized_loss: bool = False):
+              return_normalized_loss: bool = False, n_workers: Union[int, None] = None,
+              screen_points: Union[int, None] = None, top_k: int = 3,
+              race: Union[int, None] = None, race_steps: int = 100, learning_rate: float = 1e-3,
+              n_nearest: Union[int, None] = None):
         """
         Restores the model from the cache and uses it for retraining.
         Args:
@@ -477,6 +2018,14 @@ class Cache():
             model_randomize_parameter:  Creates a random model parameters (weights, biases) multiplied with a given
                                         randomize parameter.
             cache_model: cached model
+            n_workers: number of threads loading the cached models.
+            screen_points: number of points used for the cache screening (see cache_lookup).
+            top_k: number of the best screened models evaluated on the whole problem.
+            race: number of the best cached models raced (see Cache.cache_race),
+                  **uses only in 'NN' and 'autograd' modes.**
+            race_steps: training steps of the first race round.
+            learning_rate: learning rate used in the race.
+            n_nearest: number of the models of the nearest problems evaluated (see cache_lookup).
 
         Returns:
             cache.cache_nn or cache.cache_mat
@@ -485,8 +2034,13 @@ class Cache():
         if self.mode != 'mat':
             return self.cache_nn(nmodels, lambda_operator, lambda_bound,
                                  cache_verbose, model_randomize_parameter,
-                                 cache_model, return_normalized_loss=return_normalized_loss)
+                                 cache_model, return_normalized_loss=return_normalized_loss,
+                                 n_workers=n_workers, screen_points=screen_points,
+                                 top_k=top_k, race=race, race_steps=race_steps,
+                                 learning_rate=learning_rate, n_nearest=n_nearest)
         elif self.mode == 'mat':
             return self.cache_mat(nmodels, lambda_operator, lambda_bound,
                                   cache_verbose, model_randomize_parameter,
-                                  cache_model, return_normalized_loss=return_normalized_loss)
+                                  cache_model, return_normalized_loss=return_normalized_loss,
+                                  n_workers=n_workers, screen_points=screen_points,
+                                  top_k=top_k, n_nearest=n_nearest)
@@ -0,0 +1,409 @@
+"""Storage backends of the cached models, so several solver nodes may share them."""
+
+import os
+import json
+import glob
+import tempfile
+import threading
+import http.client
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Union, Iterator
+
+
+class CacheStorage:
+    """
+    Interface of the storage of the cached models. Entries are addressed by
+    the model file name (key) and have the metadata (the cache index record,
+    see cache.CacheIndex). Writes may be buffered until flush, reads are
+    streamed by chunks.
+    """
+
+    chunk_size = 2 ** 20
+
+    @staticmethod
+    def check_key(key: str):
+        """
+        Keys are plain file names.
+
+        Args:
+            key: entry key.
+        """
+        if not key or key in ('.', '..') or os.path.basename(key) != key or '\\' in key:
+            raise NameError('Cache storage key should be a file name, got {}'.format(key))
+
+    def put(self, key: str, data: bytes, metadata: dict):
+        """
+        Stores the entry, the entry with the same key is replaced.
+
+        Args:
+            key: entry key.
+            data: serialized model.
+            metadata: JSON serializable metadata of the entry.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Writes the buffered entries.
+        """
+
+    def get(self, key: str) -> Iterator[bytes]:
+        """
+        Reads the entry, KeyError is raised if it is not found.
+
+        Args:
+            key: entry key.
+
+        Returns:
+            iterator of the data chunks.
+        """
+        raise NotImplementedError
+
+    def list(self) -> dict:
+        """
+        Returns:
+            dict with the keys of the stored entries as keys and metadata as values.
+        """
+        raise NotImplementedError
+
+    def evict(self, keys: list):
+        """
+        Removes the entries, absent keys are skipped.
+
+        Args:
+            keys: keys of the entries.
+        """
+        raise NotImplementedError
+
+
+class LocalStorage(CacheStorage):
+    """
+    Entries are files of the directory, metadata is stored in the '.meta.json'
+    file along with the entry. Files are written to the temporary file first and
+    atomically renamed, so the directory may be shared (e.g. network file system).
+    """
+
+    meta_suffix = '.meta.json'
+
+    def __init__(self, directory: str):
+        """
+        Args:
+            directory: directory where entries are stored.
+        """
+        self.directory = directory
+
+    def path(self, key: str) -> str:
+        """
+        Args:
+            key: entry key.
+
+        Returns:
+            path of the entry file.
+        """
+        self.check_key(key)
+        return os.path.join(self.directory, key)
+
+    def write(self, path: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put(self, key: str, data: bytes, metadata: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        # the entry is listed only after its data is written
+        self.write(path, data)
+        self.write(path + self.meta_suffix, json.dumps(metadata).encode())
+
+    def get(self, key: str) -> Iterator[bytes]:
+        try:
+            file = open(self.path(key), 'rb')
+        except FileNotFoundError:
+            raise KeyError(key)
+        return self.read_chunks(file)
+
+    def read_chunks(self, file) -> Iterator[bytes]:
+        with file:
+            while True:
+                chunk = file.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def size(self, key: str) -> int:
+        """
+        Args:
+            key: entry key.
+
+        Returns:
+            size of the entry data in bytes.
+        """
+        try:
+            return os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def list(self) -> dict:
+        entries = {}
+        for meta_path in glob.glob(os.path.join(glob.escape(self.directory), '*' + self.meta_suffix)):
+            key = os.path.basename(meta_path)[:-len(self.meta_suffix)]
+            try:
+                with open(meta_path) as meta:
+                    entries[key] = json.load(meta)
+            except (OSError, ValueError):
+                # removed concurrently
+                continue
+        return entries
+
+    def evict(self, keys: list):
+        for key in keys:
+            path = self.path(key)
+            # metadata is removed first, so the entry is not listed without data
+            for path in (path + self.meta_suffix, path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class KVStorage(CacheStorage):
+    """
+    Client of the key-value server (see KVServer) over HTTP. Entries are sent
+    in batches of batch_size entries (or batch_bytes bytes), so a node saving
+    many models (e.g. models.Ensemble members) makes one request. Entries are
+    read by chunks, the model is not kept in memory as a whole.
+    """
+
+    def __init__(self, address: str, batch_size: int = 16, batch_bytes: int = 2 ** 26,
+                 timeout: float = 30.):
+        """
+        Args:
+            address: server address, e.g. 'http://127.0.0.1:8000'.
+            batch_size: maximal number of the buffered entries.
+            batch_bytes: maximal size of the buffered entries.
+            timeout: timeout of the connection in seconds.
+        """
+        url = urllib.parse.urlsplit(address)
+        if url.scheme != 'http' or url.hostname is None:
+            raise NameError("KVStorage address should be 'http://host:port', got {}".format(address))
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.timeout = timeout
+        self.pending = []
+        self.pending_bytes = 0
+        self.lock = threading.Lock()
+
+    def request(self, method: str, path: str, body: Union[bytes, None] = None):
+        """
+        Sends the request, the response is returned unread.
+
+        Args:
+            method: HTTP method.
+            path: request path.
+            body: request body.
+
+        Returns:
+            connection and response.
+        """
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body=body)
+            response = connection.getresponse()
+        except Exception:
+            connection.close()
+            raise
+        if response.status == 404:
+            connection.close()
+            raise KeyError(path)
+        if response.status != 200:
+            message = response.read().decode(errors='replace')
+            connection.close()
+            raise OSError('Cache storage error {}: {}'.format(response.status, message))
+        return connection, response
+
+    def put(self, key: str, data: bytes, metadata: dict):
+        self.check_key(key)
+        with self.lock:
+            self.pending = [entry for entry in self.pending if entry[0] != key]
+            self.pending.append((key, bytes(data), metadata))
+            self.pending_bytes = sum(len(entry[1]) for entry in self.pending)
+            full = len(self.pending) >= self.batch_size or self.pending_bytes >= self.batch_bytes
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending, self.pending_bytes = self.pending, [], 0
+            if not pending:
+                return
+            # JSON header line with the entries, then their data one after another
+            header = [{'key': key, 'metadata': metadata, 'size': len(data)}
+                      for key, data, metadata in pending]
+            body = b''.join([json.dumps(header).encode() + b'\n'] +
+                            [data for _, data, _ in pending])
+            try:
+                connection, response = self.request('POST', '/batch', body)
+            except Exception:
+                # entries are kept for the next flush
+                self.pending = pending + self.pending
+                self.pending_bytes = sum(len(entry[1]) for entry in self.pending)
+                raise
+        response.read()
+        connection.close()
+
+    def get(self, key: str) -> Iterator[bytes]:
+        self.check_key(key)
+        connection, response = self.request('GET', '/data/' + urllib.parse.quote(key))
+        return self.read_chunks(connection, response)
+
+    def read_chunks(self, connection, response) -> Iterator[bytes]:
+        try:
+            while True:
+                chunk = response.read(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            connection.close()
+
+    def list(self) -> dict:
+        # own buffered entries are visible
+        self.flush()
+        connection, response = self.request('GET', '/keys')
+        try:
+            return json.loads(response.read())
+        finally:
+            connection.close()
+
+    def evict(self, keys: list):
+        with self.lock:
+            self.pending = [entry for entry in self.pending if entry[0] not in keys]
+            self.pending_bytes = sum(len(entry[1]) for entry in self.pending)
+        connection, response = self.request('POST', '/evict', json.dumps(list(keys)).encode())
+        response.read()
+        connection.close()
+
+
+class KVRequestHandler(BaseHTTPRequestHandler):
+    """
+    Requests of KVStorage, entries are kept in the server storage.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status: int, body: bytes = b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        storage = self.server.storage
+        try:
+            if self.path == '/keys':
+                self.reply(200, json.dumps(storage.list()).encode())
+            elif self.path.startswith('/data/'):
+                key = urllib.parse.unquote(self.path[len('/data/'):])
+                size = storage.size(key)
+                chunks = storage.get(key)
+                self.send_response(200)
+                self.send_header('Content-Length', str(size))
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(chunk)
+            else:
+                self.reply(404)
+        except KeyError:
+            self.reply(404)
+        except NameError as error:
+            self.reply(400, str(error).encode())
+
+    def do_POST(self):
+        storage = self.server.storage
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            if self.path == '/batch':
+                header = self.rfile.readline()
+                length -= len(header)
+                for entry in json.loads(header):
+                    data = self.rfile.read(entry['size'])
+                    length -= len(data)
+                    storage.put(entry['key'], data, entry['metadata'])
+                self.reply(200)
+            elif self.path == '/evict':
+                storage.evict(json.loads(self.rfile.read(length)))
+                length = 0
+                self.reply(200)
+            else:
+                self.reply(404)
+        except (NameError, ValueError, KeyError) as error:
+            # the rest of the request is dropped
+            self.rfile.read(max(length, 0))
+            self.reply(400, str(error).encode())
+
+
+class KVServer:
+    """
+    Simple key-value server of the cached models, entries are stored in the
+    directory (see LocalStorage). It is run in the background thread, e.g. for
+    testing of KVStorage or as the cache of the nodes of one machine.
+    """
+
+    def __init__(self, directory: str, host: str = '127.0.0.1', port: int = 0):
+        """
+        Args:
+            directory: directory where entries are stored.
+            host: host the server is bound to.
+            port: port the server is bound to, if 0 a free port is chosen.
+        """
+        self.storage = LocalStorage(directory)
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    @property
+    def address(self) -> str:
+        return 'http://{}:{}'.format(self.host, self.port)
+
+    def start(self) -> 'KVServer':
+        """
+        Starts the server in the background thread.
+
+        Returns:
+            the server itself.
+        """
+        self.server = ThreadingHTTPServer((self.host, self.port), KVRequestHandler)
+        self.server.daemon_threads = True
+        self.server.storage = self.storage
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -1,13 +1,42 @@
 import torch
-from typing import Any, Union
+from typing import Any, Union, Tuple
 import numpy as np
 from scipy import linalg
 
+from tedeous.models import Ensemble
+from tedeous.utils import grid_index
+
 
 class DerivativeInt():
     def take_derivative(self, value):
         raise NotImplementedError
 
+    def clear_tape(self):
+        """
+        Clears memoized derivatives, should be called when the model is changed.
+        """
+        pass
+
+    def check_tape(self):
+        """
+        Clears the tape if the model is replaced or its parameters are changed
+        since the tape is started (i.e. by the optimizer step or load_state_dict).
+        Changes made through parameter.data are not tracked, clear_tape should
+        be called after them.
+        """
+        state = (id(self.model),) + tuple(parameter._version for parameter in self.model.parameters())
+        if state != getattr(self, 'tape_state', None):
+            self.clear_tape()
+            self.tape_state = state
+
+    def register_grids(self, owner: Any, prepared: Union[list, dict, None],
+                       grid: Union[torch.Tensor, None] = None):
+        """
+        Registers prepared operator (boundary conditions) defined on the grid,
+        so the strategy can precompute auxiliary structures for it.
+        """
+        pass
+
 
 class Derivative_NN(DerivativeInt):
     """
@@ -20,6 +49,154 @@ class Derivative_NN(DerivativeInt):
             model: neural network.
         """
         self.model = model
+        self.prepared = {}
+        self.grid = None
+        self.grid_pos = {}
+        self.points = None
+        self.output = None
+        self.tape = {}
+
+    @staticmethod
+    def terms(prepared: Union[list, dict, None]):
+        """
+        Iterates over all terms of the prepared operator (boundary conditions).
+
+        Args:
+            prepared: prepared operator or list of prepared boundary conditions.
+        Yields:
+            operator terms.
+        """
+        if isinstance(prepared, dict):
+            if 'coeff' in prepared and 'pow' in prepared:
+                yield prepared
+            else:
+                for value in prepared.values():
+                    yield from Derivative_NN.terms(value)
+        elif isinstance(prepared, (list, tuple)):
+            for item in prepared:
+                yield from Derivative_NN.terms(item)
+
+    def register_grids(self, owner: Any, prepared: Union[list, dict, None],
+                       grid: Union[torch.Tensor, None] = None):
+        """
+        Collects all distinct shifted grids of the prepared operators into one
+        tensor, so the model is evaluated on all of them in one forward pass.
+        Grids in the prepared operators are replaced by views of this tensor.
+        Grids which consist of the points of the base grid (e.g. the stencil is
+        aligned with the grid) are taken from the forward pass on the base grid
+        by indices, if it is cheaper than evaluating them separately. Stencil
+        points which fall off the base grid (e.g. wide central stencils near the
+        boundary) are appended to the forward pass, only they are evaluated
+        in addition to the base grid.
+
+        Args:
+            owner: object the prepared structure belongs to (registering for the same
+                   owner again replaces the structure, e.g. after adding points).
+            prepared: prepared operator or list of prepared boundary conditions.
+            grid: base grid.
+        """
+        self.prepared[owner] = prepared
+        if grid is not None:
+            self.grid = grid
+        grids = {}
+        for term in self.terms(list(self.prepared.values())):
+            dif_dir = list(term.keys())[1]
+            for scheme in term[dif_dir][0]:
+                for s_grid in scheme:
+                    grids[id(s_grid)] = s_grid
+        self.grid_pos = {}
+        self.points = None
+        if len(grids) == 0:
+            self.clear_tape()
+            return
+        on_grid = {}
+        if self.grid is not None:
+            # grids shifted off the base grid (e.g. the step is not aligned with it)
+            # are recognized by a sample of their points, so they are not searched
+            # the sample is spread over the grid, its first points may be off the grid
+            # near the boundary
+            samples = [s_grid[::max(1, len(s_grid) // 16)] for s_grid in grids.values()]
+            sample = grid_index(self.grid, torch.cat(samples), exact=True)
+            sample = sample.split([len(s_sample) for s_sample in samples])
+            candidates = {key: s_grid for (key, s_grid), s_pos in zip(grids.items(), sample)
+                          if (s_pos < 0).float().mean() <= 0.5}
+            if candidates:
+                pos = grid_index(self.grid, torch.cat(list(candidates.values())), exact=True)
+                pos = pos.split([len(s_grid) for s_grid in candidates.values()])
+            else:
+                pos = []
+            for key, s_pos in zip(candidates.keys(), pos):
+                missed = s_pos < 0
+                # shifted off the grid, points are not searched further
+                if missed.float().mean() > 0.5:
+                    continue
+                if missed.any():
+                    s_pos = s_pos.clone()
+                    s_pos[missed] = grid_index(self.grid, grids[key][missed.to(grids[key].device)])
+                on_grid[key] = s_pos
+            # points of the stencils which fall off the grid (e.g. near the boundary)
+            # are evaluated separately, the rest is taken from the base grid
+            saved = sum(int((s_pos >= 0).sum()) for s_pos in on_grid.values())
+            if saved <= len(self.grid):
+                on_grid = {}
+        parts = [self.grid.detach()] if on_grid else []
+        start = len(self.grid) if on_grid else 0
+        views = {}
+        for key, s_grid in grids.items():
+            if key in on_grid:
+                s_pos = on_grid[key]
+                missed = s_pos < 0
+                if missed.any():
+                    parts.append(s_grid[missed.to(s_grid.device)].detach())
+                    s_pos[missed] = torch.arange(start, start + int(missed.sum()),
+                                                 device=s_pos.device)
+                    start += int(missed.sum())
+                # grid is stored to keep id(grid) unique
+                self.grid_pos[key] = (s_grid, s_pos)
+            else:
+                parts.append(s_grid.detach())
+                views[key] = (start, start + len(s_grid))
+                start += len(s_grid)
+        self.points = torch.cat(parts)
+        for key, (begin, end) in views.items():
+            view = self.points[begin:end]
+            views[key] = view
+            self.grid_pos[id(view)] = (view, slice(begin, end))
+        for term in self.terms(list(self.prepared.values())):
+            dif_dir = list(term.keys())[1]
+            for scheme in term[dif_dir][0]:
+                for k, s_grid in enumerate(scheme):
+                    if id(s_grid) in views:
+                        scheme[k] = views[id(s_grid)]
+        self.clear_tape()
+
+    def clear_tape(self):
+        """
+        Clears the model output, it is valid only while model parameters
+        are unchanged, i.e. during one evaluation.
+        """
+        self.output = None
+        self.tape = {}
+
+    def grid_forward(self, grid: torch.Tensor) -> torch.Tensor:
+        """
+        Model output on the grid. For registered grids the output is taken from
+        one forward pass on all registered grids, other grids are evaluated
+        separately. Outputs are memoized until clear_tape.
+
+        Args:
+            grid: shifted grid.
+        Returns:
+            model output.
+        """
+        if id(grid) in self.grid_pos:
+            if self.output is None:
+                self.output = self.model(self.points)
+            index = self.grid_pos[id(grid)][1]
+            return self.output[..., index, :]
+        if id(grid) not in self.tape:
+            self.tape[id(grid)] = (grid, self.model(grid))
+        return self.tape[id(grid)][1]
 
     def take_derivative(self, term: Union[list, int, torch.Tensor], *args) -> torch.Tensor:
         """
@@ -31,6 +208,7 @@ class Derivative_NN(DerivativeInt):
             resulting field, computed on a grid.
         """
 
+        self.check_tape()
         dif_dir = list(term.keys())[1]
         if type(term['coeff']) is tuple:
             coeff = term['coeff'][0](term['coeff'][1]).reshape(-1, 1)
@@ -41,7 +219,7 @@ class Derivative_NN(DerivativeInt):
         for j, scheme in enumerate(term[dif_dir][0]):
             grid_sum = 0.
             for k, grid in enumerate(scheme):
-                grid_sum += self.model(grid)[:, term['var'][j]].reshape(-1, 1)\
+                grid_sum += self.grid_forward(grid)[..., term['var'][j]].unsqueeze(-1)\
                     * term[dif_dir][1][j][k]
             der_term = der_term * grid_sum ** term['pow'][j]
         der_term = coeff * der_term
@@ -56,29 +234,57 @@ class Derivative_autograd(DerivativeInt):
 
     def __init__(self, model):
         self.model = model
+        self.tape = {}
 
-    @staticmethod
-    def nn_autograd(model, points, var, axis=[0]):
+    def clear_tape(self):
+        """
+        Clears memoized forward passes and derivatives. Tape is valid only
+        while model parameters are unchanged, i.e. during one evaluation.
         """
-        Computes derivative on the grid using autograd method.
+        self.tape = {}
+
+    def points_forward(self, points: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Model forward pass on the points, computed once per tape.
+
         Args:
-            model: neural network.
             points: points, where numerical derivative is calculated.
-            axis: term of differentiation, example [0,0]->d2/dx2
-                  if grid_points(x,y)
         Returns:
-            the result of desired function differentiation
-                in corresponding axis.
-
+            - model input (points with gradient, copied for every model of models.Ensemble).
+            - model output.
         """
+        key = (id(points),)
+        if key not in self.tape:
+            if isinstance(self.model, Ensemble):
+                inputs = self.model.expand_points(points)
+            else:
+                inputs = points
+            if not inputs.requires_grad:
+                inputs.requires_grad = True
+            # points are stored to keep id(points) unique while the tape is alive
+            self.tape[key] = (points, inputs, self.model(inputs))
+        return self.tape[key][1], self.tape[key][2]
+
+    def tape_derivative(self, points: torch.Tensor, var: int, axis: tuple) -> torch.Tensor:
+        """
+        Computes derivative using memoized lower order derivatives, i.e.
+        d2u/dx2 is taken from the gradient of du/dx stored on the tape.
 
-        points.requires_grad = True
-        fi = model(points)[:, var].sum(0)
-        for ax in axis:
-            grads, = torch.autograd.grad(fi, points, create_graph=True)
-            fi = grads[:, ax].sum()
-        gradient_full = grads[:, axis[-1]].reshape(-1, 1)
-        return gradient_full
+        Args:
+            points: points, where numerical derivative is calculated.
+            var: number of the model output.
+            axis: term of differentiation, example (0,0)->d2/dx2, () for the function itself.
+        Returns:
+            the result of desired function differentiation in corresponding axis.
+        """
+        inputs, output = self.points_forward(points)
+        if len(axis) == 0:
+            return output[..., var]
+        key = (id(points), var, axis[:-1])
+        if key not in self.tape:
+            lower = self.tape_derivative(points, var, axis[:-1])
+            self.tape[key], = torch.autograd.grad(lower.sum(), inputs, create_graph=True)
+        return self.tape[key][..., axis[-1]]
 
     def take_derivative(self, term: dict, grid_points:  torch.Tensor) -> torch.Tensor:
         """
@@ -91,6 +297,7 @@ class Derivative_autograd(DerivativeInt):
             resulting field, computed on a grid.
         """
 
+        self.check_tape()
         dif_dir = list(term.keys())[1]
         # it is may be int, function of grid or torch.Tensor
         if callable(term['coeff']):
@@ -101,10 +308,9 @@ class Derivative_autograd(DerivativeInt):
         der_term = 1.
         for j, derivative in enumerate(term[dif_dir]):
             if derivative == [None]:
-                der = self.model(grid_points)[:, term['var'][j]].reshape(-1, 1)
-            else:
-                der = self.nn_autograd(
-                    self.model, grid_points, term['var'][j], axis=derivative)
+                derivative = []
+            der = self.tape_derivative(
+                grid_points, term['var'][j], tuple(derivative)).unsqueeze(-1)
             der_term = der_term * der ** term['pow'][j]
         der_term = coeff * der_term
 
@@ -132,6 +338,9 @@ class Derivative_mat(DerivativeInt):
 
         self.farw = [int(i) for i in range(num_points)]
 
+        self.h_grid = None
+        self.h = None
+
 
     @staticmethod
     def labels(num_points):
@@ -185,6 +394,17 @@ class Derivative_mat(DerivativeInt):
 
 
     def step_h(self, h_tensor: torch.Tensor) -> list[torch.Tensor]:
+        """
+        Computes grid steps along every axis. Steps are computed once
+        for the grid and reused on the next calls.
+
+        Args:
+            h_tensor: grid (see solver.grid_format_prepare).
+        Returns:
+            list of the grid steps.
+        """
+        if self.h_grid is h_tensor:
+            return self.h
         h = []
 
         NN_grid = torch.vstack([h_tensor[i].reshape(-1) for i in \
@@ -193,6 +413,8 @@ class Derivative_mat(DerivativeInt):
         for i in range(NN_grid.shape[-1]):
             axis_points = torch.unique(NN_grid[:,i])
             h.append(abs(axis_points[1]-axis_points[0]))
+        self.h_grid = h_tensor
+        self.h = h
         return h
 
     def derivative(self, u_tensor: torch.Tensor, h, axis: int) -> torch.Tensor:
@@ -2,9 +2,10 @@ import torch
 from typing import Tuple, Union
 
 from tedeous.points_type import Points_type
-from tedeous.derivative import Derivative
+from tedeous.derivative import Derivative, DerivativeInt
+from tedeous.models import Ensemble
 from tedeous.device import device_type, check_device
-from tedeous.utils import PadTransform
+from tedeous.utils import PadTransform, batch_indices, select_points, append_points, select_bcond
 
 
 def integration(func: torch.tensor, grid, pow: Union[int, float] = 2) \
@@ -71,12 +72,17 @@ def dict_to_matrix(bval: dict, true_bval: dict):
     keys = list(bval.keys())
     max_len = max([len(i) for i in bval.values()])
     pad = PadTransform(max_len, 0)
-    matrix_bval = pad(bval[keys[0]]).float().reshape(-1,1)
-    matrix_true_bval = pad(true_bval[keys[0]]).float().reshape(-1,1)
+
+    def pad_column(val):
+        # bval of Ensemble model has column for every model
+        return pad(val.transpose(0, -1)).transpose(0, -1).float().reshape(max_len, -1)
+
+    matrix_bval = pad_column(bval[keys[0]])
+    matrix_true_bval = pad_column(true_bval[keys[0]]).expand(-1, matrix_bval.shape[-1])
     len_list = [len(bval[keys[0]])]
     for key in keys[1:]:
-        bval_i = pad(bval[key]).float().reshape(-1,1)
-        true_bval_i = pad(true_bval[key]).float().reshape(-1,1)
+        bval_i = pad_column(bval[key])
+        true_bval_i = pad_column(true_bval[key]).expand(-1, bval_i.shape[-1])
         matrix_bval = torch.hstack((matrix_bval, bval_i))
         matrix_true_bval = torch.hstack((matrix_true_bval, true_bval_i))
         len_list.append(len(bval[key]))
@@ -90,18 +96,54 @@ class Operator():
     """
     def __init__(self, grid: torch.Tensor, prepared_operator: Union[list,dict],
                  model: Union[torch.nn.Sequential, torch.Tensor], mode: str,
-                 weak_form: list[callable], derivative_points: int):
+                 weak_form: list[callable], derivative_points: int,
+                 batch_size: Union[int, None] = None, stratified: bool = False,
+                 derivative_cls: Union[DerivativeInt, None] = None):
+        """
+        Args:
+            grid: array of a n-D points.
+            prepared_operator: prepared (see input_preprocessing) operator.
+            model: neural network or matrix depending on the selected mode.
+            mode: calculation method. (i.e., "NN", "autograd", "mat").
+            weak_form: list of basis functions.
+            derivative_points: number of points for finite difference in 'mat' mode.
+            batch_size: number of collocation points sampled at each evaluation,
+                        if None the whole grid is used.
+            stratified: sample the batch proportionally to every point type
+                        (see Points_type.grid_sort). **Uses only in 'autograd' mode**,
+                        'NN' operator is prepared on 'central' points only.
+            derivative_cls: derivative strategy shared with other operators, it is
+                            created if None. Derivatives are memoized by the strategy
+                            until derivative_cls.clear_tape() is called or the model
+                            parameters are changed (see DerivativeInt.check_tape).
+        """
         self.grid = check_device(grid)
         self.prepared_operator = prepared_operator
         self.model = model.to(device_type())
         self.mode = mode
         self.weak_form = weak_form
         self.derivative_points = derivative_points
+        self.batch_size = batch_size
+        self.strata = None
+        self.ensemble = isinstance(self.model, Ensemble)
+        if batch_size is not None and stratified and self.mode != 'autograd':
+            raise ValueError("Stratified mini-batch sampling is available only for 'autograd' mode.")
         if self.mode == 'NN':
             self.grid_dict = Points_type(self.grid).grid_sort()
             self.sorted_grid = torch.cat(list(self.grid_dict.values()))
+            self.n_points = len(self.grid_dict['central'])
         elif self.mode == 'autograd' or self.mode == 'mat':
             self.sorted_grid = self.grid
+            self.n_points = len(self.grid)
+        if derivative_cls is None:
+            derivative_cls = Derivative(self.model, self.derivative_points).set_strategy(self.mode)
+        self.derivative_cls = derivative_cls
+        self.derivative = self.derivative_cls.take_derivative
+        if batch_size is None:
+            self.derivative_cls.register_grids(self, self.prepared_operator, self.grid)
+        if batch_size is not None and stratified:
+            self.strata = {p_type: torch.nonzero(mask).reshape(-1)
+                           for p_type, mask in Points_type(self.grid).type_masks().items()}
 
     def apply_operator(self, operator: list, grid_points: Union[torch.Tensor, None]) -> torch.Tensor:
         """
@@ -114,36 +156,100 @@ class Operator():
         Returns:
             Decoded operator on a single grid subset
         """
-        derivative = Derivative(self.model,self.derivative_points).set_strategy(self.mode).take_derivative
         for term in operator:
             term = operator[term]
-            dif = derivative(term, grid_points)
+            dif = self.derivative(term, grid_points)
             try:
                 total += dif
             except NameError:
                 total = dif
         return total
 
-    def pde_compute(self) -> torch.Tensor:
+    def batch_sample(self) -> Tuple[list, torch.Tensor]:
+        """
+        Draws random subset of collocation points for mini-batch evaluation.
+
+        Returns:
+            - prepared operator restricted to the sampled points.
+            - sampled grid points.
+        """
+        if self.batch_size is None or self.batch_size >= self.n_points:
+            return self.prepared_operator, self.sorted_grid
+        strata = list(self.strata.values()) if self.strata is not None else None
+        idx = batch_indices(self.n_points, self.batch_size, strata)
+        prepared_operator = select_points(self.prepared_operator, idx, self.mode)
+        if self.mode == 'NN':
+            grid_points = self.grid_dict['central'][idx]
+        else:
+            grid_points = self.sorted_grid[idx]
+        return prepared_operator, grid_points.detach()
+
+    def add_points(self, points: torch.Tensor, prepared_operator: list):
+        """
+        Extends the collocation set with new inner points without preparing
+        the whole grid from scratch.
+
+        Args:
+            points: new inner points.
+            prepared_operator: operator prepared on the new points only
+                               (see input_preprocessing operator_prepare).
+        """
+        self.prepared_operator = append_points(self.prepared_operator,
+                                               prepared_operator, self.mode)
+        new_idx = torch.arange(self.n_points, self.n_points + len(points))
+        if self.mode == 'NN':
+            self.grid_dict['central'] = torch.cat((self.grid_dict['central'], points))
+            self.sorted_grid = torch.cat(list(self.grid_dict.values()))
+        else:
+            self.grid = torch.cat((self.grid, points)).detach()
+            self.sorted_grid = self.grid
+        if self.batch_size is None:
+            self.derivative_cls.register_grids(self, self.prepared_operator, self.grid)
+        if self.strata is not None:
+            self.strata['central'] = torch.cat((self.strata.get('central', new_idx[:0]), new_idx))
+        self.n_points += len(points)
+
+    def pde_compute(self, prepared_operator: Union[list, None] = None,
+                    grid_points: Union[torch.Tensor, None] = None) -> torch.Tensor:
         """
         Computes PDE residual.
 
+        Args:
+            prepared_operator: operator prepared on grid_points, if None
+                               the (sampled) collocation set is used.
+            grid_points: points, where the residual is computed.
+
         Returns:
             PDE residual.
         """
 
-        num_of_eq = len(self.prepared_operator)
+        if prepared_operator is None:
+            prepared_operator, grid_points = self.batch_sample()
+        num_of_eq = len(prepared_operator)
         if num_of_eq == 1:
-            op = self.apply_operator(
-                self.prepared_operator[0], self.sorted_grid).reshape(-1,1)
+            op = self.op_columns(self.apply_operator(
+                prepared_operator[0], grid_points))
         else:
             op_list = []
             for i in range(num_of_eq):
-                op_list.append(self.apply_operator(
-                    self.prepared_operator[i], self.sorted_grid).reshape(-1,1))
+                op_list.append(self.op_columns(self.apply_operator(
+                    prepared_operator[i], grid_points)))
             op = torch.cat(op_list, 1)
         return op
 
+    def op_columns(self, op: torch.Tensor) -> torch.Tensor:
+        """
+        Reshapes equation residual to columns.
+
+        Args:
+            op: residual of one equation.
+        Returns:
+            residual column, or column for every model if model is Ensemble.
+        """
+        if self.ensemble:
+            return op.reshape(self.model.n_members, -1).T
+        return op.reshape(-1, 1)
+
 
     def weak_pde_compute(self, weak_form) -> torch.Tensor:
         """
@@ -188,14 +294,31 @@ class Bounds():
     """
     def __init__(self, grid: torch.Tensor, prepared_bconds: Union[list,dict],
                  model: Union[torch.nn.Sequential, torch.Tensor], mode: str,
-                 weak_form: list[callable], derivative_points: int):
+                 weak_form: list[callable], derivative_points: int,
+                 batch_size: Union[int, None] = None,
+                 derivative_cls: Union[DerivativeInt, None] = None):
+        """
+        Args:
+            grid: array of a n-D points.
+            prepared_bconds: prepared (see input_preprocessing) boundary conditions.
+            model: neural network or matrix depending on the selected mode.
+            mode: calculation method. (i.e., "NN", "autograd", "mat").
+            weak_form: list of basis functions.
+            derivative_points: number of points for finite difference in 'mat' mode.
+            batch_size: number of points sampled from every boundary condition at
+                        each evaluation, if None all boundary points are used.
+            derivative_cls: derivative strategy shared with the Operator, it is created if None.
+        """
         self.grid = check_device(grid)
         self.prepared_bconds = prepared_bconds
         self.model = model.to(device_type())
         self.mode = mode
-        self.apply_operator = Operator(self.grid, self.prepared_bconds,
-                                       self.model, self.mode, weak_form,
-                                       derivative_points).apply_operator
+        self.batch_size = batch_size
+        self.ensemble = isinstance(self.model, Ensemble)
+        self.operator = Operator(self.grid, self.prepared_bconds,
+                                 self.model, self.mode, weak_form,
+                                 derivative_points, derivative_cls=derivative_cls)
+        self.apply_operator = self.operator.apply_operator
 
     def apply_bconds_set(self, operator_set: list) -> torch.Tensor:
         """
@@ -209,7 +332,7 @@ class Bounds():
         field_part = []
         for operator in operator_set:
             field_part.append(self.apply_operator(operator, None))
-        field_part = torch.cat(field_part)
+        field_part = torch.cat(field_part, dim=-2)
         return field_part
 
     def apply_dirichlet(self, bnd: torch.Tensor, var: int) -> torch.Tensor:
@@ -223,12 +346,9 @@ class Bounds():
             calculated boundary condition.
         """
         if self.mode == 'NN' or self.mode == 'autograd':
-            b_op_val = self.model(bnd)[:, var].reshape(-1, 1)
+            b_op_val = self.model(bnd)[..., var].unsqueeze(-1)
         elif self.mode == 'mat':
-            b_op_val = []
-            for position in bnd:
-                    b_op_val.append(self.model[var][position])
-            b_op_val = torch.cat(b_op_val).reshape(-1, 1)
+            b_op_val = torch.take(self.model[var], bnd).reshape(-1, 1)
         return b_op_val
 
     def apply_neumann(self, bnd: torch.Tensor, bop: list) -> torch.Tensor:
@@ -248,10 +368,7 @@ class Bounds():
         elif self.mode == 'mat':
             var = bop[list(bop.keys())[0]]['var'][0]
             b_op_val = self.apply_operator(bop, self.grid)
-            b_val = []
-            for position in bnd:
-                b_val.append(b_op_val[var][position])
-            b_op_val = torch.cat(b_val).reshape(-1, 1)
+            b_op_val = torch.take(b_op_val[var], bnd).reshape(-1, 1)
         return b_op_val
 
     def apply_periodic(self, bnd: torch.Tensor, bop: list, var: int) -> torch.Tensor:
@@ -311,6 +428,68 @@ class Bounds():
                                            bcond['var'])
         return b_op_val
 
+    @staticmethod
+    def prepared_size(equation: dict) -> int:
+        """
+        Number of points the 'NN' operator is prepared on.
+
+        Args:
+            equation: prepared operator of one equation.
+
+        Returns:
+            number of points.
+        """
+        term = list(equation.values())[0]
+        return len(term[list(term.keys())[1]][0][0][0])
+
+    def select_types(self, bop: list, idx: torch.Tensor) -> list:
+        """
+        Restricts the 'NN' boundary operator to the subset of points. The operator
+        is prepared for every point type separately and its values are concatenated
+        (see apply_bconds_set), so idx are positions in this concatenation.
+
+        Args:
+            bop: boundary operator prepared for every point type.
+            idx: sorted indices of the points subset.
+
+        Returns:
+            boundary operator restricted to the points subset.
+        """
+        selected = []
+        offset = 0
+        for equation in bop:
+            n_type = self.prepared_size(equation)
+            local = idx[(idx >= offset) & (idx < offset + n_type)] - offset
+            if len(local) > 0:
+                selected.append(select_points([equation], local, self.mode)[0])
+            offset += n_type
+        return selected
+
+    def batch_sample(self) -> list:
+        """
+        Draws random subset of points for every boundary condition.
+
+        Returns:
+            prepared boundary conditions restricted to the sampled points.
+        """
+        if self.batch_size is None:
+            return self.prepared_bconds
+        bconds = []
+        for bcond in self.prepared_bconds:
+            n_bnd = len(bcond['bval'])
+            if n_bnd <= self.batch_size:
+                bconds.append(bcond)
+                continue
+            idx = torch.sort(batch_indices(n_bnd, self.batch_size))[0]
+            selected = select_bcond(bcond, idx, self.mode)
+            if self.mode == 'NN' and bcond['bop'] is not None:
+                if bcond['type'] == 'periodic':
+                    selected['bop'] = [self.select_types(bop, idx) for bop in bcond['bop']]
+                else:
+                    selected['bop'] = self.select_types(bcond['bop'], idx)
+            bconds.append(selected)
+        return bconds
+
     def apply_bcs(self) -> Tuple[dict, dict]:
         """
         Applies boundary conditions for each term in prepared_bconds.
@@ -324,14 +503,19 @@ class Bounds():
         bval_dict = {}
         true_bval_dict = {}
 
-        for bcond in self.prepared_bconds:
+        for bcond in self.batch_sample():
+            b_op_val = self.b_op_val_calc(bcond)
+            if self.ensemble:
+                b_op_val = b_op_val.reshape(self.model.n_members, -1).T
+            else:
+                b_op_val = b_op_val.reshape(-1)
             try:
                 bval_dict[bcond['type']] = torch.cat((bval_dict[bcond['type']],
-                                                    self.b_op_val_calc(bcond).reshape(-1)))
+                                                    b_op_val))
                 true_bval_dict[bcond['type']] = torch.cat((true_bval_dict[bcond['type']],
                                                     bcond['bval'].reshape(-1)))
             except:
-                bval_dict[bcond['type']] = self.b_op_val_calc(bcond).reshape(-1)
+                bval_dict[bcond['type']] = b_op_val
                 true_bval_dict[bcond['type']] = bcond['bval'].reshape(-1)
 
         bval, true_bval, keys, bval_length = dict_to_matrix(
@@ -1,9 +1,24 @@
 from copy import deepcopy, copy
 import numpy as np
-from typing import Tuple
+from typing import Tuple, Union
 flatten_list = lambda t: [item for sublist in t for item in sublist]
 
 
+def axis_step(h: Union[float, list], axis: int) -> float:
+    """
+    Step of the scheme along the axis.
+
+    Args:
+        h: discretizing parameter, single value or list with value for every axis.
+        axis: axis.
+    Returns:
+        step along the axis.
+    """
+    if isinstance(h, (list, tuple)):
+        return h[axis]
+    return h
+
+
 class First_order_scheme():
     """
     Class for numerical scheme construction. Central o(h^2) difference scheme
@@ -84,7 +99,7 @@ class First_order_scheme():
             finite_diff = diff_list
         return finite_diff
 
-    def sign_order(self, h: float = 1 / 2) -> list :
+    def sign_order(self, h: Union[float, list] = 1 / 2) -> list :
         """
         Determines the sign of the derivative for the corresponding transformation from Finite_diffs.scheme_build().
 
@@ -95,7 +110,8 @@ class First_order_scheme():
         [[1,0],[-1,0]] ([+1,-1])->[[1,1],[1,-1],[-1,1],[-1,-1]] ([+1,-1,-1,+1])
 
         Args:
-            h: discretizing parameter in finite difference method (i.e., grid resolution for scheme).
+            h: discretizing parameter in finite difference method (i.e., grid resolution for scheme),
+               single value or list with value for every axis.
 
         Returns:
             list, with signs for corresponding points.
@@ -103,12 +119,13 @@ class First_order_scheme():
         sign_list = [1]
         for i in range(len(self.term)):
             start_list = []
+            h_i = axis_step(h, self.term[i])
             for sign in sign_list:
                 if np.unique(self.direction_list)[0] == 'central':
-                    start_list.append([sign * (1 / (2 * h)),
-                                       -sign * (1 / (2 * h))])
+                    start_list.append([sign * (1 / (2 * h_i)),
+                                       -sign * (1 / (2 * h_i))])
                 else:
-                    start_list.append([sign / h, -sign / h])
+                    start_list.append([sign / h_i, -sign / h_i])
             sign_list = flatten_list(start_list)
         return sign_list
 
@@ -180,12 +197,13 @@ class Second_order_scheme():
             finite_diff = diff_list
         return finite_diff
 
-    def sign_order(self, h: float = 1/2) -> list:
+    def sign_order(self, h: Union[float, list] = 1/2) -> list:
         """
         Signs definition for second order schemes.
 
         Args:
-            h: discretizing parameter in finite difference method (i.e., grid resolution for scheme).
+            h: discretizing parameter in finite difference method (i.e., grid resolution for scheme),
+               single value or list with value for every axis.
         Returns:
             list, with signs for corresponding points.
         """
@@ -193,15 +211,16 @@ class Second_order_scheme():
         sign_list = [1]
         for i in range(len(self.term)):
             start_list = []
+            h_i = axis_step(h, self.term[i])
             for sign in sign_list:
                 if self.direction_list[i] == 'f':
-                    start_list.append([3 * (1 / (2 * h)) * sign,
-                                       -4 * (1 / (2 * h)) * sign,
-                                       (1 / (2 * h)) * sign])
+                    start_list.append([3 * (1 / (2 * h_i)) * sign,
+                                       -4 * (1 / (2 * h_i)) * sign,
+                                       (1 / (2 * h_i)) * sign])
                 elif self.direction_list[i] == 'b':
-                    start_list.append([-3 * (1 / (2 * h)) * sign,
-                                       4 * (1 / (2 * h)) * sign,
-                                       -(1 / (2 * h)) * sign])
+                    start_list.append([-3 * (1 / (2 * h_i)) * sign,
+                                       4 * (1 / (2 * h_i)) * sign,
+                                       -(1 / (2 * h_i)) * sign])
             sign_list = flatten_list(start_list)
         return sign_list
 
@@ -223,7 +242,7 @@ class Finite_diffs():
         self.nvars = nvars
         self.axes_scheme_type = axes_scheme_type
 
-    def scheme_choose(self, scheme_label: str, h:float = 1 / 2):
+    def scheme_choose(self, scheme_label: str, h: Union[float, list] = 1 / 2):
         """
         Method for numerical scheme choosing via realized above.
 
@@ -232,7 +251,8 @@ class Finite_diffs():
                 '2'- for second order scheme (only boundaries points),
                 '1' - for first order scheme.
 
-            h: discretizing parameter in finite difference method (i.e., grid resolution for scheme).
+            h: discretizing parameter in finite difference method (i.e., grid resolution for scheme),
+               single value or list with value for every axis.
 
         Returns:
             list where list[0] is numerical scheme and list[1] is signs.
@@ -1,11 +1,14 @@
+import json
 import torch
 import numpy as np
 from copy import deepcopy
 from typing import Union, Tuple
 
 from tedeous.points_type import Points_type
-from tedeous.finite_diffs import Finite_diffs
+from tedeous.finite_diffs import Finite_diffs, axis_step
 from tedeous.device import check_device
+from tedeous.utils import grid_index
+from tedeous.prepared_cache import PreparedCache
 
 def lambda_prepare(val, lambda_: Union[int, list, torch.Tensor]) -> torch.Tensor :
     """
@@ -233,16 +236,7 @@ class EquationMixin:
         Returns:
             position of the boundary point on the grid.
         """
-        min_dist = np.inf
-        pos = 0
-        min_pos = 0
-        for point in grid:
-            dist = torch.linalg.norm(point - target_point)
-            if dist < min_dist:
-                min_dist = dist
-                min_pos = pos
-            pos += 1
-        return min_pos
+        return int(grid_index(grid, target_point.reshape(1, -1), nearest=True)[0])
 
     @staticmethod
     def convert_to_double(bnd: Union[list, np.array]) -> float:
@@ -267,7 +261,8 @@ class EquationMixin:
     @staticmethod
     def search_pos(grid: torch.Tensor, bnd) -> list:
         """
-        Method for searching position bnd in grid.
+        Method for searching position bnd in grid. Points which are not in the
+        grid are mapped to the closest grid points (see utils.grid_index).
 
         Args:
             grid: array of a n-D points.
@@ -280,15 +275,7 @@ class EquationMixin:
             for i, cur_bnd in enumerate(bnd):
                 bnd[i] = EquationMixin.search_pos(grid, cur_bnd)
             return bnd
-        pos_list = []
-        for point in bnd:
-            try:
-                pos = int(torch.where(torch.all(
-                    torch.isclose(grid, point), dim=1))[0])
-            except Exception:
-                pos = EquationMixin.closest_point(grid, point)
-            pos_list.append(pos)
-        return pos_list
+        return grid_index(grid, bnd.reshape(len(bnd), -1), nearest=True).tolist()
 
     @staticmethod
     def bndpos(grid: torch.Tensor, bnd: torch.Tensor) -> Union[list, int]:
@@ -317,7 +304,8 @@ class Equation_NN(EquationMixin, Points_type):
     """
 
     def __init__(self, grid: torch.Tensor, operator:  Union[dict, list], bconds, h: float = 0.001,
-                 inner_order: str = '1', boundary_order: str = '2'):
+                 inner_order: str = '1', boundary_order: str = '2', grid_aligned: bool = False,
+                 prepared_cache_dir: Union[str, None] = None):
         """
         Prepares equation, boundary conditions for NN method.
 
@@ -328,14 +316,91 @@ class Equation_NN(EquationMixin, Points_type):
             h: discretizing parameter in finite difference method (i.e., grid resolution for scheme).
             inner_order: accuracy inner order for finite difference. Default = 1
             boundary_order: accuracy boundary order for finite difference. Default = 2
+            grid_aligned: if True, h is ignored and the step along every axis is equal to
+                          the grid step, so the stencil points are grid points and the
+                          model is evaluated on the grid only. Grid should be uniform
+                          tensor product grid. Wide stencils near the boundary (e.g. the
+                          +-2h points of central second derivatives) fall off the grid,
+                          only these points are evaluated in addition to the grid.
+            prepared_cache_dir: directory where points typization, boundary points
+                                sorting and the prepared operator and boundary conditions
+                                are stored (see PreparedCache). If None, they are
+                                computed every time.
         """
         super().__init__(grid)
         self.grid = grid
         self.operator = operator
         self.bconds = bconds
-        self.h = h
+        self.grid_aligned = grid_aligned
+        self.h = self.grid_step() if grid_aligned else h
+        self.prepared_cache = None
+        if prepared_cache_dir is not None:
+            self.prepared_cache = PreparedCache(prepared_cache_dir)
         self.inner_order = inner_order
         self.boundary_order = boundary_order
+        self.shift_table = {}
+
+    def type_masks(self) -> dict:
+        """
+        Points typization (see Points_type.type_masks), it is taken from
+        the prepared cache if the cache is used.
+
+        Returns:
+            dict with point types as keys and boolean masks as values.
+        """
+
+        if self.prepared_cache is None:
+            return super().type_masks()
+
+        def compute():
+            masks = super(Equation_NN, self).type_masks()
+            return {p_type: torch.nonzero(mask).reshape(-1) for p_type, mask in masks.items()}
+
+        key = 'types_' + PreparedCache.tensor_hash(self.grid)
+        masks = {}
+        for p_type, index in self.prepared_cache.cached(key, compute).items():
+            masks[p_type] = torch.zeros(len(self.grid), dtype=torch.bool)
+            masks[p_type][index.cpu()] = True
+        return masks
+
+    def bnd_index(self, grid_dict: dict, b_coord: torch.Tensor, tol: float = 1e-5) -> dict:
+        """
+        Boundary points sorting (see Points_type.bnd_index), it is taken from
+        the prepared cache if the cache is used.
+
+        Returns:
+            dict with point types as keys and indices of the boundary points as values.
+        """
+
+        if self.prepared_cache is None:
+            return super().bnd_index(grid_dict, b_coord, tol)
+
+        def compute():
+            return super(Equation_NN, self).bnd_index(grid_dict, b_coord, tol)
+
+        key = 'bnd_' + PreparedCache.tensor_hash(self.grid, b_coord, extra=str(tol))
+        return self.prepared_cache.cached(key, compute)
+
+    def grid_step(self) -> list:
+        """
+        Computes the step of the uniform tensor product grid along every axis.
+
+        Returns:
+            list with the step for every axis.
+        """
+
+        h = []
+        n_nodes = 1
+        for axis in range(self.grid.shape[-1]):
+            nodes = torch.unique(self.grid[:, axis])
+            steps = torch.diff(nodes)
+            if len(steps) == 0 or not torch.allclose(steps, steps[0], rtol=1e-3):
+                raise NameError('Grid-aligned finite differences need uniform grid along every axis')
+            h.append(steps.mean().item())
+            n_nodes *= len(nodes)
+        if n_nodes != len(self.grid):
+            raise NameError('Grid-aligned finite differences need tensor product grid')
+        return h
 
     def operator_to_type_op(self, dif_direction: list, nvars: int, axes_scheme_type: str) -> list:
         """
@@ -366,11 +431,38 @@ class Equation_NN(EquationMixin, Points_type):
             s_order_list.append(s_order)
         return [fin_diff_list, s_order_list]
 
+    def shifted_grid(self, grid_points: torch.Tensor, shifts: list) -> torch.Tensor:
+        """
+        Returns grid_points shifted by integer steps 'shifts'. Every unique shift
+        of the grid_points is stored once in shift_table, so identical stencil
+        points of different terms (e.g. (x+h) for du/dx and d2u/dx2) refer
+        to the same tensor and are evaluated once.
+
+        Args:
+            grid_points: grid points that will be shifted.
+            shifts: integer steps along every axis.
+        Returns:
+            shifted grid points.
+        """
+
+        if not any(shifts):
+            return grid_points
+        key = (id(grid_points), tuple(shifts))
+        if key not in self.shift_table:
+            s_grid = grid_points
+            for j, axis in enumerate(shifts):
+                if axis != 0:
+                    s_grid = self.shift_points(s_grid, j, axis * axis_step(self.h, j))
+            # grid_points is stored to keep id(grid_points) unique
+            self.shift_table[key] = (grid_points, s_grid)
+        return self.shift_table[key][1]
+
     def finite_diff_scheme_to_grid_list(self, finite_diff_scheme: list, grid_points: torch.Tensor) -> list:
         """
         Method that converts integer finite difference steps in term described
         in Finite_diffs class to a grids with shifted points, i.e.
-        from field (x,y) -> (x,y+h).
+        from field (x,y) -> (x,y+h). Identical shifts refer to one tensor
+        (see shifted_grid).
 
         Args:
             finite_diff_scheme: operator_to_type_op one term
@@ -385,10 +477,7 @@ class Equation_NN(EquationMixin, Points_type):
             if shifts is None:
                 s_grid_list.append(grid_points)
             else:
-                s_grid = grid_points
-                for j, axis in enumerate(shifts):
-                    s_grid = self.shift_points(s_grid, j, axis * self.h)
-                s_grid_list.append(s_grid)
+                s_grid_list.append(self.shifted_grid(grid_points, shifts))
         return s_grid_list
 
     def checking_coeff(self, coeff: Union[int, float, torch.Tensor], grid_points: torch.Tensor):
@@ -464,28 +553,115 @@ class Equation_NN(EquationMixin, Points_type):
                 term[dif_term][0], grid_points)
         return operator
 
-    def operator_prepare(self) -> list:
+    def prepared_key(self, name: str, tensors: list, structure) -> str:
+        """
+        Key of the prepared cache entry.
+
+        Args:
+            name: entry name.
+            tensors: tensors the entry depends on (besides the grid).
+            structure: JSON serializable description of the prepared
+                       operators (see operator_structure).
+
+        Returns:
+            entry key.
+        """
+
+        extra = json.dumps([structure, self.h, self.inner_order, self.boundary_order],
+                           default=str)
+        return name + '_' + PreparedCache.tensor_hash(self.grid, *tensors, extra=extra)
+
+    def operator_structure(self, operator: dict) -> list:
+        """
+        The stencils of the prepared operator depend only on the
+        differentiation directions of its terms.
+
+        Args:
+            operator: operator in input form (unified).
+
+        Returns:
+            list of terms labels and differentiation directions.
+        """
+
+        operator = self.equation_unify(operator)
+        return [[label, term[list(term.keys())[1]]] for label, term in operator.items()]
+
+    @staticmethod
+    def operator_stencils(operator: dict) -> dict:
+        """
+        Args:
+            operator: prepared operator (see one_operator_prepare).
+
+        Returns:
+            dict with terms labels as keys and shifted grids with
+            the schemes signs as values.
+        """
+
+        return {label: term[list(term.keys())[1]] for label, term in operator.items()}
+
+    def stencils_operator_prepare(self, operator: dict, stencils: dict,
+                                  grid_points: torch.Tensor) -> dict:
+        """
+        Same as one_operator_prepare, but the stencils are taken from the
+        prepared cache (see operator_stencils).
+
+        Args:
+            operator: operator in input form.
+            stencils: stencils of the operator terms.
+            grid_points: points the operator is prepared on.
+
+        Returns:
+            prepared operator
+        """
+
+        operator = self.equation_unify(operator)
+        for operator_label in operator:
+            term = operator[operator_label]
+            dif_term = list(term.keys())[1]
+            term['coeff'] = self.checking_coeff(term['coeff'], grid_points)
+            term[dif_term] = stencils[operator_label]
+        return operator
+
+    def operator_prepare(self, grid_points: Union[torch.Tensor, None] = None) -> list:
         """
         Method for all operators preparing. If system case is, it will call
         'one_operator_prepare' method for number of equations times.
+        The operator on 'central' points is taken from the prepared cache if
+        the cache is used.
+
+        Args:
+            grid_points: inner points the operator is prepared on, if None
+                         'central' points of the grid are used.
 
         Returns:
             list of dictionaries, where every dictionary is the result of
                 'one_operator_prepare'
         """
 
-        grid_points = self.grid_sort()['central']
+        self.shift_table = {}
         if type(self.operator) is list and type(self.operator[0]) is dict:
-            num_of_eq = len(self.operator)
-            prepared_operator = []
-            for i in range(num_of_eq):
-                equation = self.one_operator_prepare(
-                    self.operator[i], grid_points, 'central')
-                prepared_operator.append(equation)
+            operators = self.operator
         else:
+            operators = [self.operator]
+        key = None
+        if grid_points is None and self.prepared_cache is not None:
+            key = self.prepared_key('operator', [], [self.operator_structure(operator)
+                                                     for operator in operators])
+            cached = self.prepared_cache.load(key)
+            if cached is not None:
+                return [self.stencils_operator_prepare(operator, stencils, cached['points'])
+                        for operator, stencils in zip(operators, cached['stencils'])]
+        if grid_points is None:
+            grid_points = self.grid_sort()['central']
+        prepared_operator = []
+        for operator in operators:
             equation = self.one_operator_prepare(
-                self.operator, grid_points, 'central')
-            prepared_operator = [equation]
+                operator, grid_points, 'central')
+            prepared_operator.append(equation)
+        if key is not None:
+            self.prepared_cache.save(key, {
+                'points': grid_points,
+                'stencils': [self.operator_stencils(equation) for equation in prepared_operator]})
 
         return prepared_operator
 
@@ -510,18 +686,102 @@ class Equation_NN(EquationMixin, Points_type):
             operator_list.append(equation)
         return operator_list
 
-    def bnd_prepare(self) -> list:
+    def bnd_stencils(self, bnd_operator: list, bnd_dict: dict) -> list:
         """
-        Method for boundary conditions preparing to final form.
+        Args:
+            bnd_operator: apply_bnd_operators result.
+            bnd_dict: dictionary (keys is points type, values is boundary points).
+
+        Returns:
+            list of points type, boundary points and stencils (see operator_stencils)
+            for every points type in bnd_dict.
+        """
+
+        return [[points_type, bnd_dict[points_type], self.operator_stencils(equation)]
+                for points_type, equation in zip(bnd_dict.keys(), bnd_operator)]
+
+    def stencils_bnd_operators(self, bnd_operator: dict, bnd_stencils: list) -> list:
+        """
+        Same as apply_bnd_operators, but the stencils are taken from the
+        prepared cache (see bnd_stencils).
+
+        Args:
+            bnd_operator: boundary operator in input form.
+            bnd_stencils: bnd_stencils result.
+
+        Returns:
+            final form of differential operator used in the algorithm for
+                subset grid types.
+        """
+
+        return [self.stencils_operator_prepare(deepcopy(bnd_operator), stencils, points)
+                for _, points, stencils in bnd_stencils]
+
+    def cached_bnd_prepare(self, bconds: list) -> list:
+        """
+        Prepares the boundary operators of the unified conditions with
+        the prepared cache.
+
+        Args:
+            bconds: unified boundary conditions (see Boundary.bnd_unify).
 
         Returns:
             list of dictionaries where every dict is one boundary condition
         """
 
+        tensors, structure = [], []
+        for bcond in bconds:
+            bnd = bcond['bnd'] if type(bcond['bnd']) is list else [bcond['bnd']]
+            tensors.extend(bnd)
+            bop = None if bcond['bop'] is None else self.operator_structure(bcond['bop'])
+            structure.append([bcond['type'], len(bnd), bop])
+        key = self.prepared_key('bconds', tensors, structure)
+        cached = self.prepared_cache.load(key)
+        if cached is not None:
+            for bcond, bnd_stencils in zip(bconds, cached):
+                if bcond['bop'] is None:
+                    continue
+                if bcond['type'] == 'periodic':
+                    bcond['bop'] = [self.stencils_bnd_operators(bcond['bop'], i)
+                                    for i in bnd_stencils]
+                else:
+                    bcond['bop'] = self.stencils_bnd_operators(bcond['bop'], bnd_stencils)
+            return bconds
         grid_dict = self.grid_sort()
+        entry = []
+        for bcond in bconds:
+            if bcond['bop'] is None:
+                entry.append(None)
+                continue
+            bnd_dict = self.bnd_sort(grid_dict, bcond['bnd'])
+            if bcond['type'] == 'periodic':
+                bcond['bop'] = [self.apply_bnd_operators(
+                    bcond['bop'], i) for i in bnd_dict]
+                entry.append([self.bnd_stencils(bop, i)
+                              for bop, i in zip(bcond['bop'], bnd_dict)])
+            else:
+                bcond['bop'] = self.apply_bnd_operators(
+                    bcond['bop'], bnd_dict)
+                entry.append(self.bnd_stencils(bcond['bop'], bnd_dict))
+        self.prepared_cache.save(key, entry)
+        return bconds
+
+    def bnd_prepare(self) -> list:
+        """
+        Method for boundary conditions preparing to final form. Boundary
+        operators are taken from the prepared cache if the cache is used.
+
+        Returns:
+            list of dictionaries where every dict is one boundary condition
+        """
+
+        self.shift_table = {}
         bconds1 = Boundary(self.bconds).bnd_unify()
         if bconds1 == None:
             return None
+        if self.prepared_cache is not None:
+            return self.cached_bnd_prepare(bconds1)
+        grid_dict = self.grid_sort()
         for bcond in bconds1:
             bnd_dict = self.bnd_sort(grid_dict, bcond['bnd'])
             if bcond['bop'] != None:
@@ -552,12 +812,15 @@ class Equation_autograd(EquationMixin):
         self.operator = operator
         self.bconds = bconds
 
-    def checking_coeff(self, coeff: Union[int, float, torch.Tensor]) -> Union[int, float, torch.Tensor]:
+    def checking_coeff(self, coeff: Union[int, float, torch.Tensor],
+                       grid_points: Union[torch.Tensor, None] = None) -> Union[int, float, torch.Tensor]:
         """
         Checks the coefficient type
 
         Args:
             coeff: coefficient in equation operator.
+            grid_points: points the operator is prepared on, if None the whole grid is used.
+                         Tensor coefficient is taken in the closest grid points.
         Returns:
             coefficient
         """
@@ -569,17 +832,24 @@ class Equation_autograd(EquationMixin):
         elif type(coeff) == torch.Tensor:
             coeff = check_device(coeff)
             coeff1 = coeff.reshape(-1, 1)
+            if grid_points is not None:
+                coeff1 = coeff1[self.bndpos(self.grid, grid_points)]
         elif type(coeff) is torch.nn.parameter.Parameter:
             coeff1 = coeff
         else:
             raise NameError('"coeff" should be: torch.Tensor or callable or int or float!')
         return coeff1
 
-    def one_operator_prepare(self, operator: dict) -> dict:
+    def one_operator_prepare(self, operator: dict,
+                             grid_points: Union[torch.Tensor, None] = None) -> dict:
         """
         Method for all operators preparing. If system case is, it will call
         'one_operator_prepare' method for number of equations times.
 
+        Args:
+            operator: operator in input form.
+            grid_points: see checking_coeff method.
+
         Returns:
             list of dictionaries, where every dictionary is the result of
                 'one_operator_prepare'
@@ -588,14 +858,17 @@ class Equation_autograd(EquationMixin):
         operator = self.equation_unify(operator)
         for operator_label in operator:
             term = operator[operator_label]
-            term['coeff'] = self.checking_coeff(term['coeff'])
+            term['coeff'] = self.checking_coeff(term['coeff'], grid_points)
         return operator
 
-    def operator_prepare(self) -> list:
+    def operator_prepare(self, grid_points: Union[torch.Tensor, None] = None) -> list:
         """
         Method for all operators preparing. If system case is, it will call
         'one_operator_prepare' method for number of equations times.
 
+        Args:
+            grid_points: points the operator is prepared on, if None the whole grid is used.
+
         Returns:
             list of dictionaries, where every dictionary is the result of
                 'one_operator_prepare'
@@ -607,10 +880,10 @@ class Equation_autograd(EquationMixin):
             prepared_operator = []
             for i in range(num_of_eq):
                 equation = self.equation_unify(self.operator[i])
-                prepared_operator.append(self.one_operator_prepare(equation))
+                prepared_operator.append(self.one_operator_prepare(equation, grid_points))
         else:
             equation = self.equation_unify(self.operator)
-            prepared_operator = [self.one_operator_prepare(equation)]
+            prepared_operator = [self.one_operator_prepare(equation, grid_points)]
 
         return prepared_operator
 
@@ -673,29 +946,29 @@ class Equation_mat(EquationMixin):
 
         return prepared_operator
 
-    def point_position(self, bnd) -> list:
+    def point_position(self, bnd) -> torch.Tensor:
         """
-        Define position of boundary points on the grid.
+        Define position of boundary points on the grid. Positions are
+        computed for all points at once from the grid nodes along every axis.
 
         Args:
-            bnd:
+            bnd: boundary points.
 
         Returns:
-            list of positions, where boundary points intersects on the grid.
+            flat indices of the grid points the boundary points intersect with
+            (for torch.take). Points which are not on the grid are skipped.
         """
-        bpos = []
-        for pt in bnd:
-            if self.grid.shape[0] == 1:
-                point_pos = (torch.tensor(self.bndpos(self.grid, pt)),)
-            else:
-                prod = (torch.zeros_like(self.grid[0]) + 1).bool()
-                for axis in range(self.grid.shape[0]):
-                    axis_intersect = torch.isclose(
-                        pt[axis].float(), self.grid[axis].float())
-                    prod *= axis_intersect
-                point_pos = torch.where(prod == True)
-            bpos.append(point_pos)
-        return bpos
+        n_axes = self.grid.shape[0]
+        bnd = bnd.reshape(len(bnd), -1)
+        index = torch.zeros(len(bnd), dtype=torch.long, device=self.grid.device)
+        on_grid = torch.ones(len(bnd), dtype=torch.bool, device=self.grid.device)
+        for axis in range(n_axes):
+            nodes = self.grid[axis].movedim(axis, 0).reshape(self.grid.shape[axis + 1], -1)[:, 0]
+            pos = grid_index(nodes.reshape(-1, 1), bnd[:, axis].reshape(-1, 1),
+                             nearest=(n_axes == 1))
+            on_grid &= pos >= 0
+            index = index * len(nodes) + pos
+        return index[on_grid]
 
     def bnd_prepare(self) -> list:
         """
@@ -723,7 +996,8 @@ class Equation():
     Interface for preparing equations due to chosen calculation method.
     """
     def __init__(self, grid: torch.Tensor, operator: Union[dict, list], bconds: list, h: float = 0.001,
-                 inner_order: str ='1', boundary_order: str ='2'):
+                 inner_order: str ='1', boundary_order: str ='2', grid_aligned: bool = False,
+                 prepared_cache_dir: Union[str, None] = None):
         """
         Args:
             grid: array of a n-D points.
@@ -732,6 +1006,10 @@ class Equation():
             h: discretizing parameter in finite difference method (i.e., grid resolution for scheme).
             inner_order: accuracy inner order for finite difference. Default = 1
             boundary_order:  accuracy boundary order for finite difference. Default = 2
+            grid_aligned: finite difference steps are equal to the grid steps
+                          (see Equation_NN). **Uses only in 'NN' mode.**
+            prepared_cache_dir: directory of the prepared problems cache
+                                (see Equation_NN). **Uses only in 'NN' mode.**
         """
         self.grid = check_device(grid)
         self.operator = operator
@@ -739,6 +1017,8 @@ class Equation():
         self.h = h
         self.inner_order = inner_order
         self.boundary_order = boundary_order
+        self.grid_aligned = grid_aligned
+        self.prepared_cache_dir = prepared_cache_dir
 
     def set_strategy(self, strategy: str) -> Union[Equation_NN, Equation_mat, Equation_autograd]:
         """
@@ -752,7 +1032,9 @@ class Equation():
         if strategy == 'NN':
             return Equation_NN(self.grid, self.operator, self.bconds, h=self.h,
                                inner_order=self.inner_order,
-                               boundary_order=self.boundary_order)
+                               boundary_order=self.boundary_order,
+                               grid_aligned=self.grid_aligned,
+                               prepared_cache_dir=self.prepared_cache_dir)
         if strategy == 'mat':
             return Equation_mat(self.grid, self.operator, self.bconds)
         if strategy == 'autograd':
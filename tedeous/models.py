@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+from copy import deepcopy
 
 
 class Fourier_embedding(nn.Module):
@@ -149,6 +150,81 @@ class FeedForward(nn.Module):
             self.net.register_parameter(key, parameters[key])
 
 
+class Ensemble(nn.Module):
+    """
+    Class for vectorized training of several models with the same architecture.
+    Parameters of the models are stacked (torch.func.stack_module_state) and
+    all models are evaluated in one vmapped forward pass, so the output has
+    the leading dimension equal to the number of models.
+
+    Args:
+        models: list of models with the same architecture.
+    """
+
+    def __init__(self, models: list):
+        super(Ensemble, self).__init__()
+        params, buffers = torch.func.stack_module_state(models)
+        self.n_members = len(models)
+        self.param_names = list(params.keys())
+        self.buffer_names = list(buffers.keys())
+        self.params = nn.ParameterList([nn.Parameter(params[name]) for name in self.param_names])
+        for i, name in enumerate(self.buffer_names):
+            self.register_buffer('buffer_{}'.format(i), buffers[name])
+        # base model is not registered as submodule, it stores only the architecture
+        object.__setattr__(self, 'base', deepcopy(models[0]).to('meta'))
+
+    def expand_points(self, grid: torch.Tensor) -> torch.Tensor:
+        """
+        Copies grid for every model, so derivatives w.r.t. the points can be
+        taken for all models in one backward pass.
+
+        Args:
+            grid: calculation domain.
+        Returns:
+            grid with the leading dimension equal to the number of models.
+        """
+        return grid.detach().unsqueeze(0).repeat(self.n_members, *[1] * grid.dim())
+
+    def forward(self, grid: torch.Tensor) -> torch.Tensor:
+        """
+        Forward pass for all models.
+
+        Args:
+            grid: calculation domain, common (n_points, n_dims) or separate for
+                  every model (n_members, n_points, n_dims).
+        Returns:
+            predicted values with shape (n_members, n_points, n_outputs).
+        """
+        params = dict(zip(self.param_names, self.params))
+        buffers = {name: getattr(self, 'buffer_{}'.format(i))
+                   for i, name in enumerate(self.buffer_names)}
+
+        def call(params, buffers, grid):
+            return torch.func.functional_call(self.base, (params, buffers), (grid,))
+
+        grid_dim = 0 if grid.dim() == 3 else None
+        return torch.func.vmap(call, in_dims=(0, 0, grid_dim))(params, buffers, grid)
+
+    def members(self) -> list:
+        """
+        Unstacks the ensemble to a list of independent models.
+
+        Returns:
+            list of models with the current parameters.
+        """
+        device = self.params[0].device
+        models = []
+        for i in range(self.n_members):
+            model = deepcopy(self.base).to_empty(device=device)
+            state_dict = {name: param[i].detach().clone()
+                          for name, param in zip(self.param_names, self.params)}
+            for j, name in enumerate(self.buffer_names):
+                state_dict[name] = getattr(self, 'buffer_{}'.format(j))[i].clone()
+            model.load_state_dict(state_dict)
+            models.append(model)
+        return models
+
+
 def parameter_registr(model, parameters):
     for key, value in parameters.items():
         parameters[key] = torch.nn.Parameter(torch.tensor([value],
@@ -1,7 +1,7 @@
 import numpy as np
 import torch
 from typing import Union
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
 
 
 class Points_type():
@@ -10,6 +10,7 @@ class Points_type():
     """
     def __init__(self, grid):
         self.grid = grid
+        self.bnd_tree = None
 
     @staticmethod
     def shift_points(grid: torch.Tensor, axis: int, shift: float) -> torch.Tensor:
@@ -55,17 +56,43 @@ class Points_type():
             lowbound = torch.min(hull).cpu()
             return np.array(((p.cpu() <= upbound) & (p.cpu() >= lowbound)).reshape(-1))
 
-    def point_typization(self) -> dict:
+    @staticmethod
+    def tensor_product(grid: torch.Tensor) -> bool:
         """
-        Allocating subsets for FD (i.e., 'f', 'b', 'central').
+        Checks if the grid is a tensor product grid (i.e., it contains all
+        combinations of the unique coordinates along every axis).
         Args:
             grid: array of a n-D points.
         Returns:
-            type with a points in a 'grid' above. Type may be 'central' - inner point
-            and string of 'f' and 'b', where the length of the string is a dimension n. 'f' means that if we add
-            small number to a position of corresponding coordinate we stay in the 'hull'. 'b' means that if we
-            subtract small number from o a position of corresponding coordinate we stay in the 'hull'.
+            True if the grid is a tensor product grid, False - otherwise.
         """
+        n_nodes = 1
+        node_index = torch.zeros(len(grid), dtype=torch.long, device=grid.device)
+        for axis in range(grid.shape[1]):
+            nodes, inverse = torch.unique(grid[:, axis], return_inverse=True)
+            node_index = node_index * len(nodes) + inverse
+            n_nodes *= len(nodes)
+            if n_nodes > len(grid):
+                return False
+        # every combination of the nodes is met exactly once
+        return n_nodes == len(grid) and bool((torch.bincount(node_index, minlength=n_nodes) == 1).all())
+
+    def directions(self) -> np.ndarray:
+        """
+        Checks for every point and every axis if the point stays in the grid
+        hull after small shift forward and backward along the axis.
+        For a tensor product grid the hull is a box, so the check is
+        a vectorized comparison with the per-axis bounds, otherwise
+        the Delaunay triangulation of the grid is used.
+        Returns:
+            boolean array of shape (number of points, 2 * dimension), columns are
+            (forward, backward) pairs for every axis.
+        """
+        if self.tensor_product(self.grid):
+            grid = self.grid.cpu()
+            forward = grid < grid.max(dim=0).values
+            backward = grid > grid.min(dim=0).values
+            return torch.stack((forward, backward), dim=-1).reshape(len(grid), -1).numpy()
 
         direction_list = []
         for axis in range(self.grid.shape[1]):
@@ -75,28 +102,50 @@ class Points_type():
                      self.grid, axis, (-1) ** direction * 0.0001), self.grid))
 
         direction_list = np.array(direction_list)
-        direction_list = np.transpose(direction_list)
+        return np.transpose(direction_list)
 
-        point_type = {}
+    def type_masks(self) -> dict:
+        """
+        Allocating subsets for FD (i.e., 'f', 'b', 'central') in one vectorized pass.
+        Returns:
+            dict with point types (see Points_type.point_typization) as keys and
+            boolean masks of the grid points of this type as values. 'central' is the first key.
+        """
+        direction_list = self.directions()
+        n_points, n_dim = self.grid.shape
+        central = direction_list.all(axis=1)
+        if n_dim == 1:
+            central = np.ones(n_points, dtype=bool)
+        masks = {}
+        if central.any():
+            masks['central'] = torch.from_numpy(central)
+        # 'f' along the axis if the point stays in the hull after the forward shift
+        forward = direction_list[:, ::2]
+        codes = (forward * (2 ** np.arange(n_dim))).sum(axis=1)
+        for code in np.unique(codes[~central]):
+            p_type = ''.join('f' if (code >> axis) & 1 else 'b' for axis in range(n_dim))
+            masks[p_type] = torch.from_numpy(~central & (codes == code))
+        return masks
+
+    def point_typization(self) -> dict:
+        """
+        Allocating subsets for FD (i.e., 'f', 'b', 'central').
+        Args:
+            grid: array of a n-D points.
+        Returns:
+            type with a points in a 'grid' above. Type may be 'central' - inner point
+            and string of 'f' and 'b', where the length of the string is a dimension n. 'f' means that if we add
+            small number to a position of corresponding coordinate we stay in the 'hull'. 'b' means that if we
+            subtract small number from o a position of corresponding coordinate we stay in the 'hull'.
+        """
+
+        types = np.empty(len(self.grid), dtype=object)
+        for p_type, mask in self.type_masks().items():
+            types[mask.numpy()] = p_type
 
+        point_type = {}
         for i, point in enumerate(self.grid):
-            if np.all(direction_list[i]):
-                point_type[point] = 'central'
-            else:
-                p_type = ''
-                j = 0
-                while j < len(direction_list[i]):
-                    if (j % 2 == 0 and direction_list[i, j]) or (
-                            j % 2 == 0 and direction_list[i, j] and
-                            direction_list[i, j + 1]):
-                        p_type += 'f'
-                    else:
-                        p_type += 'b'
-                    j += 2
-                if self.grid.shape[-1] == 1:
-                    point_type[point] = 'central'
-                else:
-                    point_type[point] = p_type
+            point_type[point] = types[i]
         return point_type
 
     def grid_sort(self) -> dict:
@@ -107,18 +156,41 @@ class Points_type():
         Returns:
             sorted grid in each subset (see Points_type.point_typization).
         """
-        point_type = self.point_typization()
-        point_types = set(point_type.values())
         grid_dict = {}
-        for p_type in point_types:
-            grid_dict[p_type] = []
-        for point in list(point_type.keys()):
-            p_type = point_type[point]
-            grid_dict[p_type].append(point)
-        for p_type in point_types:
-            grid_dict[p_type] = torch.stack(grid_dict[p_type])
+        for p_type, mask in self.type_masks().items():
+            grid_dict[p_type] = self.grid[mask.to(self.grid.device)]
         return grid_dict
 
+    def bnd_index(self, grid_dict: dict, b_coord: torch.Tensor, tol: float = 1e-5) -> dict:
+        """
+        Finds the points type of every boundary point. The KD-tree of the sorted
+        grid is built once for grid_dict and reused for all boundary conditions,
+        so every call is a bulk query linear in the number of boundary points.
+        Args:
+            grid_dict: sorted grid (see Points_type.grid_sort).
+            b_coord: boundary points.
+            tol: maximal distance between the boundary point and the grid point.
+        Returns:
+            dict with point types as keys and indices of the boundary points
+            of this type as values, types without boundary points are omitted.
+        """
+        if self.bnd_tree is None or self.bnd_tree[0] is not grid_dict:
+            points = torch.cat(list(grid_dict.values())).detach().cpu().double()
+            labels = torch.cat([torch.full((len(v),), i, dtype=torch.long)
+                                for i, v in enumerate(grid_dict.values())])
+            # grid_dict is stored to check that the tree is built for it
+            self.bnd_tree = (grid_dict, cKDTree(points.numpy()), labels)
+        _, tree, labels = self.bnd_tree
+        dist, pos = tree.query(b_coord.detach().cpu().double().reshape(len(b_coord), -1).numpy())
+        b_labels = labels[torch.from_numpy(pos).long()]
+        b_labels[torch.from_numpy(dist > tol)] = -1
+        bnd_index = {}
+        for i, p_type in enumerate(grid_dict.keys()):
+            idx = torch.nonzero(b_labels == i).reshape(-1)
+            if len(idx) > 0:
+                bnd_index[p_type] = idx.to(b_coord.device)
+        return bnd_index
+
     def bnd_sort(self, grid_dict: dict, b_coord: Union[torch.Tensor, list]):
         """
         Sorting boundary points
@@ -130,17 +202,8 @@ class Points_type():
                 will be list of 'bnd_dict's if 'b_coord' is list too.
         """
         def bnd_to_dict(grid_dict, b_coord):
-            bnd_dict = {}
-            for k, v in grid_dict.items():
-                bnd_dict[k] = []
-                for bnd in b_coord:
-                    if ((bnd == v).all(axis=1)).any():
-                        bnd_dict[k].append(bnd)
-                if bnd_dict[k] == []:
-                    del bnd_dict[k]
-                else:
-                    bnd_dict[k] = torch.stack(bnd_dict[k])
-            return bnd_dict
+            bnd_index = self.bnd_index(grid_dict, b_coord)
+            return {p_type: b_coord[idx] for p_type, idx in bnd_index.items()}
 
         if type(b_coord) == list:
             bnd_dict_list = [bnd_to_dict(grid_dict, bnd) for bnd in b_coord]
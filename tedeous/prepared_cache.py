@@ -0,0 +1,178 @@
+"""Content-addressed on-disk store for the results of the problem preprocessing."""
+
+import os
+import json
+import hashlib
+import tempfile
+import torch
+from typing import Union, Callable, Any
+
+from tedeous.device import device_type
+
+
+class PreparedCache:
+    """
+    Stores the expensive parts of the problem preprocessing: points typization,
+    boundary points sorting and the prepared operator and boundary conditions
+    of 'NN' mode (stencil grids of every term, see Equation_NN). Entries are
+    addressed by the hash of the tensors and the structure they are computed
+    from, so the same problem is prepared once for all solver runs. Entries are
+    nested containers of tensors, tensors are stored once even if they are shared
+    in the entry and files are loaded memory-mapped.
+    """
+
+    def __init__(self, cache_dir: str):
+        """
+        Args:
+            cache_dir: directory where prepared data is stored.
+        """
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def tensor_hash(*tensors: torch.Tensor, extra: Union[str, None] = None) -> str:
+        """
+        Computes the content hash of the tensors.
+
+        Args:
+            tensors: tensors the entry depends on.
+            extra: additional parameters the entry depends on.
+
+        Returns:
+            hex digest of the hash.
+        """
+        sha = hashlib.sha256()
+        for tensor in tensors:
+            tensor = tensor.detach().cpu().contiguous()
+            sha.update('{}{}'.format(tensor.dtype, tuple(tensor.shape)).encode())
+            sha.update(tensor.numpy().tobytes())
+        if extra is not None:
+            sha.update(extra.encode())
+        return sha.hexdigest()
+
+    def path(self, key: str) -> str:
+        """
+        Args:
+            key: entry key.
+
+        Returns:
+            path of the entry file.
+        """
+        return os.path.join(self.cache_dir, key + '.pt')
+
+    @staticmethod
+    def flatten(data: Any, tensors: list, dtypes: list, ids: dict) -> Any:
+        """
+        Converts the entry to JSON serializable skeleton, tensors are replaced
+        by their positions in tensors. Integer tensors are stored as int32 if possible.
+
+        Args:
+            data: entry.
+            tensors: stored tensors (filled).
+            dtypes: original dtypes names of the stored tensors (filled).
+            ids: positions of the stored tensors by id.
+
+        Returns:
+            skeleton of the entry.
+        """
+        if isinstance(data, torch.Tensor):
+            if id(data) not in ids:
+                tensor = data.detach().cpu()
+                dtype = str(tensor.dtype).split('.')[-1]
+                if tensor.dtype == torch.int64 and (tensor.numel() == 0 or
+                                                    tensor.abs().max() < 2 ** 31):
+                    tensor = tensor.int()
+                ids[id(data)] = {'tensor': len(tensors)}
+                tensors.append(tensor)
+                dtypes.append(dtype)
+            return ids[id(data)]
+        if isinstance(data, dict):
+            return {'dict': [[key, PreparedCache.flatten(value, tensors, dtypes, ids)]
+                             for key, value in data.items()]}
+        if isinstance(data, (list, tuple)):
+            return {'list' if isinstance(data, list) else 'tuple':
+                    [PreparedCache.flatten(item, tensors, dtypes, ids) for item in data]}
+        if data is None or isinstance(data, (bool, int, float, str)):
+            return {'value': data}
+        raise NameError('Prepared cache can store only tensors, numbers, strings and containers')
+
+    @staticmethod
+    def unflatten(skeleton: Any, tensors: list) -> Any:
+        """
+        Inverse of flatten.
+
+        Args:
+            skeleton: skeleton of the entry.
+            tensors: stored tensors (already converted to the original dtype and device).
+
+        Returns:
+            entry.
+        """
+        if 'tensor' in skeleton:
+            return tensors[skeleton['tensor']]
+        if 'dict' in skeleton:
+            return {key: PreparedCache.unflatten(value, tensors) for key, value in skeleton['dict']}
+        if 'list' in skeleton:
+            return [PreparedCache.unflatten(item, tensors) for item in skeleton['list']]
+        if 'tuple' in skeleton:
+            return tuple(PreparedCache.unflatten(item, tensors) for item in skeleton['tuple'])
+        return skeleton['value']
+
+    def load(self, key: str) -> Any:
+        """
+        Loads the entry.
+
+        Args:
+            key: entry key.
+
+        Returns:
+            entry or None if the entry is not found or can not be read.
+        """
+        try:
+            data = torch.load(self.path(key), mmap=True, weights_only=True)
+            skeleton = json.loads(data['skeleton'])
+            dtypes = data['dtypes']
+        except (OSError, RuntimeError, KeyError, ValueError):
+            # absent, partially written or stored in other format
+            return None
+        device = device_type()
+        tensors = [tensor.to(device=device, dtype=getattr(torch, dtype))
+                   for tensor, dtype in zip(data['tensors'], dtypes)]
+        return self.unflatten(skeleton, tensors)
+
+    def save(self, key: str, data: Any):
+        """
+        Saves the entry. The file is written to the temporary file first and
+        atomically renamed, so concurrent runs never read partially written entries.
+
+        Args:
+            key: entry key.
+            data: nested dicts, lists and tuples of tensors, numbers and strings.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tensors, dtypes = [], []
+        skeleton = self.flatten(data, tensors, dtypes, {})
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            torch.save({'skeleton': json.dumps(skeleton), 'tensors': tensors, 'dtypes': dtypes}, tmp_path)
+            os.replace(tmp_path, self.path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def cached(self, key: str, compute: Callable[[], Any]) -> Any:
+        """
+        Returns the stored entry, computes and stores it if it is absent.
+
+        Args:
+            key: entry key.
+            compute: function computing the entry.
+
+        Returns:
+            entry.
+        """
+        data = self.load(key)
+        if data is None:
+            data = compute()
+            self.save(key, data)
+        return data
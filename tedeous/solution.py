@@ -11,6 +11,7 @@ from tedeous.eval import Operator, Bounds
 from tedeous.losses import Losses
 from tedeous.device import device_type, check_device
 from tedeous.input_preprocessing import lambda_prepare, Equation_NN, Equation_mat, Equation_autograd
+from tedeous.models import Ensemble
 from tedeous.utils import *
 
 
@@ -22,9 +23,47 @@ class Solution():
     """
     def __init__(self, grid: torch.Tensor, equal_cls: Union[Equation_NN, Equation_mat, Equation_autograd],
                  model: Union[torch.nn.Sequential, torch.Tensor], mode: str, weak_form: Union[None, list[callable]],
-                 lambda_operator, lambda_bound, tol: float = 0, derivative_points: int = 2):
+                 lambda_operator, lambda_bound, tol: float = 0, derivative_points: int = 2,
+                 batch_size: Union[int, None] = None, bnd_batch_size: Union[int, None] = None,
+                 stratified_batch: bool = False):
+        """
+        Args:
+            grid: array of a n-D points.
+            equal_cls: object from input_preprocessing (see input_preprocessing.Equation).
+            model: neural network or matrix depending on the selected mode.
+            mode: calculation method. (i.e., "NN", "autograd", "mat").
+            weak_form: list of basis functions.
+            lambda_operator: coeff for operator part in loss.
+            lambda_bound: coeff for boundary part in loss.
+            tol: float constant, influences on error penalty in casual_loss algorithm.
+            derivative_points: number of points for finite difference in 'mat' mode.
+            batch_size: number of collocation points sampled at each evaluate call,
+                        if None the whole grid is used.
+            bnd_batch_size: number of points sampled from every boundary condition
+                            at each evaluate call, if None all boundary points are used.
+            stratified_batch: sample collocation points proportionally to every
+                              point type (see Points_type.grid_sort).
+        """
+
+        if batch_size is not None or bnd_batch_size is not None:
+            if mode == 'mat':
+                raise ValueError("Mini-batch sampling is not available for 'mat' mode.")
+            if weak_form is not None and weak_form != []:
+                raise ValueError("Mini-batch sampling and the weak form are not compatible.")
+            if tol != 0:
+                raise ValueError("Mini-batch sampling and the causal loss are not compatible.")
+
+        self.ensemble = isinstance(model, Ensemble)
+        if self.ensemble:
+            if mode == 'mat':
+                raise ValueError("Ensemble model is not available for 'mat' mode.")
+            if (weak_form is not None and weak_form != []) or tol != 0:
+                raise ValueError("Ensemble model works only with the default loss.")
+            lambda_operator = self.ensemble_lambda(lambda_operator, model.n_members)
+            lambda_bound = self.ensemble_lambda(lambda_bound, model.n_members)
 
         self.grid = check_device(grid)
+        self.equal_cls = equal_cls
         if mode == 'NN':
             sorted_grid = Points_type(self.grid).grid_sort()
             self.n_t = len(sorted_grid['central'][:, 0].unique())
@@ -45,16 +84,37 @@ class Solution():
 
 
         self.operator = Operator(self.grid, prepared_operator, self.model,
-                                   self.mode, weak_form, derivative_points)
+                                   self.mode, weak_form, derivative_points,
+                                   batch_size, stratified_batch)
         self.boundary = Bounds(self.grid, prepared_bconds, self.model,
-                                   self.mode, weak_form, derivative_points)
+                                   self.mode, weak_form, derivative_points,
+                                   bnd_batch_size, self.operator.derivative_cls)
 
         self.loss_cls = Losses(self.mode, self.weak_form, self.n_t, self.tol)
         self.eps = 0
+        self.member_loss = None
+        self.member_loss_normalized = None
         self.op_list = []
         self.bval_list = []
         self.loss_list = []
 
+    def set_model(self, model: Union[torch.nn.Module, torch.Tensor]):
+        """
+        Replaces the model, the prepared operator and boundary conditions are
+        kept. So one prepared problem can evaluate several models (e.g. cached ones).
+
+        Args:
+            model: neural network or matrix depending on the selected mode.
+        """
+        if isinstance(model, Ensemble) != self.ensemble:
+            raise ValueError("Ensemble and single model can not replace each other.")
+        self.model = model.to(device_type())
+        self.operator.model = self.model
+        self.boundary.model = self.model
+        self.boundary.operator.model = self.model
+        self.operator.derivative_cls.model = self.model
+        self.operator.derivative_cls.clear_tape()
+
     @staticmethod
     def operator_coeff(equal_cls, operator):
         for i in range(len(operator)):
@@ -67,6 +127,102 @@ class Solution():
                         eq[key]['coeff'] = equal_cls.operator[key]['coeff'].to(device_type())
 
 
+    @staticmethod
+    def ensemble_lambda(lambda_: Union[int, list, torch.Tensor], n_members: int):
+        """
+        Repeats lambdas given for every equation (boundary type) for every
+        model of the Ensemble, since each model has own residual column.
+
+        Args:
+            lambda_: regularization parameters values.
+            n_members: number of models in the Ensemble.
+
+        Returns:
+            lambdas for the Ensemble columns.
+        """
+        if type(lambda_) is list:
+            return [lam for lam in lambda_ for _ in range(n_members)]
+        elif type(lambda_) is torch.Tensor:
+            return lambda_.reshape(1, -1).repeat_interleave(n_members, dim=1)
+        return lambda_
+
+    def candidate_points(self, n_candidates: int) -> torch.Tensor:
+        """
+        Draws uniformly distributed inner points from the bounding box of the grid.
+        In 'NN' mode the box is narrowed by the finite difference step, so
+        all candidates are 'central' points. With grid-aligned finite differences
+        (see Equation_NN) the candidates are snapped to the grid nodes, since
+        their stencil points should be grid points.
+
+        Args:
+            n_candidates: number of points.
+
+        Returns:
+            candidate points.
+        """
+        grid = self.grid.detach()
+        low = torch.min(grid, 0)[0]
+        high = torch.max(grid, 0)[0]
+        if self.mode == 'NN':
+            # step is single value or list with value for every axis
+            h = torch.as_tensor(self.equal_cls.h, dtype=grid.dtype, device=grid.device)
+            low = low + h
+            high = high - h
+        points = torch.rand(n_candidates, grid.shape[-1], dtype=grid.dtype, device=grid.device)
+        points = low + (high - low) * points
+        if self.mode == 'NN' and getattr(self.equal_cls, 'grid_aligned', False):
+            for axis in range(grid.shape[-1]):
+                nodes = torch.unique(grid[:, axis])
+                pos = torch.bucketize(points[:, axis], nodes).clamp(1, len(nodes) - 1)
+                closer_left = points[:, axis] - nodes[pos - 1] < nodes[pos] - points[:, axis]
+                points[:, axis] = nodes[torch.where(closer_left, pos - 1, pos)]
+        return check_device(points)
+
+    def residual_refine(self, n_points: int, n_candidates: int = 10000,
+                        sampling: str = 'greedy') -> torch.Tensor:
+        """
+        Residual-based adaptive refinement (RAR) of the collocation points.
+        Operator is prepared only on a candidate pool, points with the
+        highest residual are added to the collocation set.
+
+        Args:
+            n_points: number of points to add.
+            n_candidates: size of the candidate pool.
+            sampling: 'greedy' - points with the highest residual are taken,
+                      'distribution' - points are sampled with probability
+                      proportional to the residual.
+
+        Returns:
+            added points.
+        """
+        if self.mode == 'mat':
+            raise ValueError("Adaptive refinement is not available for 'mat' mode.")
+        if (self.weak_form is not None and self.weak_form != []) or self.tol != 0:
+            raise ValueError("Adaptive refinement works only with the default loss.")
+
+        candidates = self.candidate_points(n_candidates)
+        prepared_operator = deepcopy(self.equal_cls).operator_prepare(candidates)
+
+        # autograd residual can not be computed without graph, so it is only detached
+        self.operator.derivative_cls.clear_tape()
+        with torch.set_grad_enabled(self.mode == 'autograd'):
+            op = self.operator.pde_compute(prepared_operator, candidates).detach()
+        self.operator.derivative_cls.clear_tape()
+        residual = torch.sum(op ** 2, 1)
+
+        n_points = min(n_points, n_candidates)
+        if sampling == 'greedy':
+            idx = torch.topk(residual, n_points)[1]
+        elif sampling == 'distribution':
+            idx = torch.multinomial(residual / torch.sum(residual), n_points)
+        else:
+            raise NameError('Wrong sampling chosen, should be "greedy" or "distribution"')
+
+        points = candidates[idx].detach()
+        self.operator.add_points(points,
+                                 select_points(prepared_operator, idx, self.mode))
+        return points
+
     def evaluate(self,
                  second_order_interactions: bool = True,
                  sampling_N: int = 1,
@@ -86,6 +242,8 @@ class Solution():
             loss
         """
 
+        # operator and boundary conditions share memoized derivatives during one evaluation
+        self.operator.derivative_cls.clear_tape()
         op = self.operator.operator_compute()
         bval, true_bval, bval_keys, bval_length = self.boundary.apply_bcs()
 
@@ -96,6 +254,20 @@ class Solution():
                                                       self.lambda_operator,
                                                       self.lambda_bound,
                                                       save_graph)
+        # memoized derivatives are not kept alive until the next evaluation
+        self.operator.derivative_cls.clear_tape()
+
+        if self.ensemble:
+            if lambda_update:
+                raise ValueError("Adaptive lambdas are not available for Ensemble model.")
+            with torch.no_grad():
+                n_members = self.model.n_members
+                op_loss = torch.mean(op ** 2, 0).reshape(-1, n_members)
+                bnd_loss = torch.mean((bval - true_bval) ** 2, 0).reshape(-1, n_members)
+                self.member_loss_normalized = torch.sum(op_loss, 0) + torch.sum(bnd_loss, 0)
+                self.member_loss = \
+                    torch.sum(op_loss * self.lambda_operator.reshape(-1, n_members), 0) + \
+                    torch.sum(bnd_loss * self.lambda_bound.reshape(-1, n_members), 0)
 
         if lambda_update:
             # TODO refactor this lambda thing to class or function.
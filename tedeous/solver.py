@@ -11,6 +11,8 @@ from torch.optim.lr_scheduler import ExponentialLR
 from tedeous.cache import *
 from tedeous.device import check_device, device_type
 from tedeous.solution import Solution
+from tedeous.models import Ensemble
+from tedeous.prepared_cache import PreparedCache
 
 
 def grid_format_prepare(coord_list, mode='NN') -> torch.Tensor:
@@ -227,6 +229,93 @@ class Solver():
                     param_str = name + '=' + str(p.item()) + ' '
         return param_str
 
+    def ensemble_optimization(self, sln_cls: Solution, optimizer: torch.optim.Optimizer,
+                              scheduler: Union[ExponentialLR, None], lr_decay: int, eps: float,
+                              tmax: float, abs_loss: Union[None, float], patience: int,
+                              loss_oscillation_window: int, no_improvement_patience: int,
+                              normalized_loss_stop: bool, verbose: int,
+                              print_every: Union[int, None]):
+        """
+        Optimization loop for models.Ensemble. The same stopping criteria as in
+        Solver.solve are applied to every model separately, parameters of the
+        stopped models are frozen while the rest are trained.
+
+        Args:
+            sln_cls: Solution object with Ensemble model.
+            optimizer: optimizer for Ensemble parameters.
+            scheduler: learning rate scheduler or None.
+            other arguments: see Solver.solve.
+        """
+        n_members = self.model.n_members
+        params = list(self.model.parameters())
+
+        def member_loss():
+            loss = sln_cls.member_loss_normalized if normalized_loss_stop else sln_cls.member_loss
+            return loss.cpu().numpy()
+
+        def closure():
+            optimizer.zero_grad()
+            loss, _ = sln_cls.evaluate()
+            loss.backward()
+            return loss
+
+        min_loss = member_loss()
+        if verbose:
+            print('[{}] initial (min) loss is {}'.format(datetime.datetime.now(), min_loss))
+
+        active = np.ones(n_members, dtype=bool)
+        stop_dings = np.zeros(n_members, dtype=int)
+        t_imp_start = np.zeros(n_members, dtype=int)
+        last_loss = np.zeros((loss_oscillation_window, n_members)) + min_loss
+        t = 0
+        while active.any():
+            frozen = [param.detach().clone() for param in params]
+            optimizer.step(closure)
+            with torch.no_grad():
+                for param, param_frozen in zip(params, frozen):
+                    param[~active] = param_frozen[~active]
+            cur_loss = member_loss()
+
+            nan_loss = cur_loss != cur_loss
+            if nan_loss.any() and verbose:
+                print('Loss is equal to NaN for models {}, they are stopped'.format(
+                    np.where(nan_loss & active)[0]))
+            active &= ~nan_loss
+
+            last_loss[(t - 1) % loss_oscillation_window] = cur_loss
+
+            improved = cur_loss < min_loss
+            min_loss = np.where(improved, cur_loss, min_loss)
+            t_imp_start[improved] = t
+
+            if scheduler != None and t % lr_decay == 0:
+                scheduler.step()
+
+            if t % loss_oscillation_window == 0 and t > 0:
+                line = np.polyfit(range(loss_oscillation_window), last_loss, 1)
+                stop_dings[np.abs(line[0] / cur_loss) < eps] += 1
+
+            no_improvement = (t - t_imp_start) == no_improvement_patience
+            t_imp_start[no_improvement] = t
+            stop_dings[no_improvement] += 1
+
+            if abs_loss != None:
+                stop_dings[cur_loss < abs_loss] += 1
+
+            stopped = active & (stop_dings > patience)
+            if stopped.any() and verbose:
+                print('[{}] Step = {} models {} are stopped with loss {}'.format(
+                    datetime.datetime.now(), t, np.where(stopped)[0], cur_loss[stopped]))
+            active &= ~stopped
+
+            if print_every != None and (t % print_every == 0) and verbose:
+                print('[{}] Step = {} loss = {}, {} models are trained'.format(
+                    datetime.datetime.now(), t, cur_loss, active.sum()))
+
+            t += 1
+            if t > tmax:
+                break
+
     def solve(self,
               lambda_operator: Union[float, list] = 1, lambda_bound: Union[float, list] = 10,
               derivative_points: float = 2, lambda_update: bool = False, second_order_interactions: bool = True,
@@ -236,6 +325,15 @@ class Solver():
               nmodels: Union[int, None] = None, name: Union[str, None] = None,
               abs_loss: Union[None, float] = None, use_cache: bool = True,
               cache_dir: str = '../cache/', cache_verbose: bool = False,
+              cache_workers: Union[int, None] = None, cache_screen_points: Union[int, None] = None,
+              cache_top_k: int = 3, cache_race: Union[int, None] = None,
+              cache_race_steps: int = 100, cache_max_entries: Union[int, None] = None,
+              cache_max_bytes: Union[int, None] = None, cache_eviction: str = 'lru',
+              cache_weights_dtype: Union[str, None] = None,
+              cache_save_optimizer: bool = False,
+              cache_storage: Union[CacheStorage, None] = None,
+              cache_nearest: Union[int, None] = None,
+              prepared_cache_dir: Union[str, None] = None,
               save_always: bool = False, print_every: Union[int, None] = 100,
               cache_model: Union[torch.nn.Sequential, None] = None,
               patience: int = 5, loss_oscillation_window: int = 100,
@@ -243,7 +341,10 @@ class Solver():
               optimizer_mode: str = 'Adam', step_plot_print: Union[bool, int] = False,
               step_plot_save: Union[bool, int] = False, image_save_dir: Union[str, None] = None, tol: float = 0,
               clear_cache: bool = False, normalized_loss_stop: bool = False, inverse_parameters: dict = None,
-              mixed_precision: bool = False) -> Any:
+              mixed_precision: bool = False, batch_size: Union[int, None] = None,
+              bnd_batch_size: Union[int, None] = None, stratified_batch: bool = False,
+              rar_every: Union[int, None] = None, rar_points: int = 100,
+              rar_candidates: int = 10000, rar_sampling: str = 'greedy') -> Any:
         """
         High-level interface for solving equations.
 
@@ -263,6 +364,35 @@ class Solver():
             use_cache: as is.
             cache_dir: directory where saved cache in.
             cache_verbose: detailed info about models in cache.
+            cache_workers: number of threads loading the cached models, if None
+                           os.cpu_count() (up to 8) is used.
+            cache_screen_points: if given, cached models are screened on the subset of points
+                                 of this size and only cache_top_k of them are evaluated
+                                 on the whole problem.
+            cache_top_k: number of the best screened models evaluated on the whole problem.
+            cache_race: if given, this number of the best cached models are trained in the
+                        successive halving race and the winner is used as the initial model
+                        ('NN' and 'autograd' modes).
+            cache_race_steps: training steps of the first race round.
+            cache_max_entries: maximal number of models in the cache, if None it is not bounded.
+            cache_max_bytes: maximal size of the cache in bytes, if None it is not bounded.
+            cache_eviction: 'lru', 'lfu' or 'loss', which models are removed if the cache
+                            is out of the budget (see cache.CacheIndex.evict).
+            cache_weights_dtype: 'float16' or 'bfloat16', the saved model weights are stored
+                                 in half precision, if None they are stored as is.
+            cache_save_optimizer: the optimizer (and gradient scaler) state is saved along
+                                  with the model (see cache.CacheUtils.save_model), the optimizer
+                                  state is restored if the cached model is used as is
+                                  (see cache.Cache.load_optimizer).
+            cache_storage: shared storage of the cached models (e.g. cache.KVStorage),
+                           saved models are put to it and its models are used as
+                           the initial ones by other solver nodes.
+            cache_nearest: if given, only this number of the cached models of the problems
+                           nearest to the current one (by the operator, domain and boundary
+                           conditions, see cache.CacheUtils.signature_distance) are evaluated.
+            prepared_cache_dir: directory where the prepared operator and boundary conditions
+                                are stored (see prepared_cache.PreparedCache), so the same problem
+                                is prepared once for all runs. **Uses only in 'NN' mode.**
             save_always: saves trained model even if the cache is False.
             print_every: prints the state of each given iteration to the command line.
             cache_model: model that uses in cache
@@ -277,6 +407,22 @@ class Solver():
             tol: float constant, influences on error penalty in casual_loss algorithm.
             derivative_points:
             sampling_N:
+            batch_size: number of collocation points sampled at each optimizer step ('NN' and 'autograd' modes),
+                        if None the whole grid is used. In 'NN' mode the operator is computed
+                        in 'central' points only, so the batch is drawn from them.
+            bnd_batch_size: number of points sampled from every boundary condition at each optimizer step,
+                            if None all boundary points are used.
+            stratified_batch: sample collocation points proportionally to every point type
+                              (see Points_type.grid_sort), **uses only in 'autograd' mode.**
+            rar_every: residual-based adaptive refinement of collocation points is performed
+                       every given step ('NN' and 'autograd' modes), if None the grid is fixed.
+            rar_points: number of points added at each refinement.
+            rar_candidates: size of the candidate pool, where the residual is computed.
+            rar_sampling: 'greedy' (points with the highest residual) or 'distribution'
+                          (sampling proportional to residual).
+
+        If model is models.Ensemble, all models are trained at once (cache is not used),
+        stopping criteria are applied to every model separately (see ensemble_optimization).
 
         Returns:
             model.
@@ -284,17 +430,30 @@ class Solver():
         """
         Cache initialization.
         """
-        cache_utils = CacheUtils()
-        if use_cache:
-            cache_utils.cache_dir = cache_dir
-            cache_cls = Cache(self.grid, self.equal_cls, self.model, self.mode, self.weak_form, mixed_precision)
+        if prepared_cache_dir is not None and hasattr(self.equal_cls, 'prepared_cache'):
+            self.equal_cls.prepared_cache = PreparedCache(prepared_cache_dir)
+        cache_utils = CacheUtils(cache_max_entries, cache_max_bytes, cache_eviction,
+                                 cache_weights_dtype, save_optimizer=cache_save_optimizer,
+                                 storage=cache_storage)
+        cache_utils.cache_dir = cache_dir
+        ensemble = isinstance(self.model, Ensemble)
+        if use_cache and not ensemble:
+            cache_cls = Cache(self.grid, self.equal_cls, self.model, self.mode, self.weak_form, mixed_precision,
+                              cache_dir=cache_dir, storage=cache_storage)
             self.model = cache_cls.cache(nmodels,
                                          lambda_operator,
                                          lambda_bound,
                                          cache_verbose,
                                          model_randomize_parameter,
                                          cache_model,
-                                         return_normalized_loss=normalized_loss_stop)
+                                         return_normalized_loss=normalized_loss_stop,
+                                         n_workers=cache_workers,
+                                         screen_points=cache_screen_points,
+                                         top_k=cache_top_k,
+                                         race=cache_race,
+                                         race_steps=cache_race_steps,
+                                         n_nearest=cache_nearest,
+                                         learning_rate=learning_rate)
 
         if clear_cache:
             cache_utils.clear_cache_dir()
@@ -302,6 +461,8 @@ class Solver():
         Optimizer and scheduler initialization.
         """
         optimizer = self.optimizer_choice(optimizer_mode, learning_rate)
+        if use_cache and not ensemble and cache_cls.load_optimizer(optimizer) and cache_verbose:
+            print('Optimizer state is restored from cache')
 
         if gamma != None:
             scheduler = ExponentialLR(optimizer, gamma=gamma)
@@ -329,10 +490,32 @@ class Solver():
         '''
         sln_cls = Solution(self.grid, self.equal_cls,
                            self.model, self.mode, self.weak_form,
-                           lambda_operator, lambda_bound, tol, derivative_points)
+                           lambda_operator, lambda_bound, tol, derivative_points,
+                           batch_size, bnd_batch_size, stratified_batch)
         with torch.autocast(device_type=device, dtype=dtype, enabled=mixed_precision):
             min_loss, _ = sln_cls.evaluate()
 
+        if ensemble:
+            self.ensemble_optimization(sln_cls, optimizer, scheduler if gamma != None else None,
+                                       lr_decay, eps, tmax, abs_loss, patience,
+                                       loss_oscillation_window, no_improvement_patience,
+                                       normalized_loss_stop, verbose, print_every)
+            if save_always:
+                if name == None:
+                    name = str(datetime.datetime.now().timestamp())
+                problem_hash = cache_utils.problem_hash(self.grid, self.equal_cls.operator,
+                                                        self.equal_cls.bconds)
+                signature = cache_utils.problem_signature(self.grid, self.equal_cls.operator,
+                                                          self.equal_cls.bconds, self.mode)
+                # the state of the Ensemble optimizer is not split between the members
+                for i, member in enumerate(self.model.members()):
+                    cache_utils.save_model(model=member,
+                                           optimizer=None,
+                                           name='{}_{}'.format(name, i),
+                                           problem_hash=problem_hash, signature=signature)
+                cache_utils.flush()
+            return self.model
+
         '''
         Verbose parameter.
         '''
@@ -389,6 +572,12 @@ class Solver():
         Optimization.
         '''
         while stop_dings <= patience:
+            if rar_every is not None and t > 0 and t % rar_every == 0:
+                points = sln_cls.residual_refine(rar_points, rar_candidates, rar_sampling)
+                if verbose:
+                    print('[{}] {} collocation points added, grid size is {}'.format(
+                        datetime.datetime.now(), len(points), sln_cls.operator.n_points))
+
             optimizer.step(closure) if not cuda_flag else closure_cuda()
 
             if cur_loss != cur_loss:
@@ -475,10 +664,19 @@ class Solver():
                 break
 
         if save_always:
+            problem_hash = cache_utils.problem_hash(self.grid, self.equal_cls.operator,
+                                                    self.equal_cls.bconds)
+            signature = cache_utils.problem_signature(self.grid, self.equal_cls.operator,
+                                                      self.equal_cls.bconds, self.mode)
             if self.mode == 'mat':
-                cache_utils.save_model_mat(model=self.model, grid=self.grid, name=name)
+                cache_utils.save_model_mat(model=self.model, grid=self.grid, name=name,
+                                           loss=float(cur_loss), problem_hash=problem_hash,
+                                           signature=signature)
             else:
                 scaler = scaler if scaler else None
                 cache_utils.save_model(model=self.model, optimizer=optimizer,
-                                       scaler=scaler, name=name)
+                                       scaler=scaler, name=name,
+                                       loss=float(cur_loss), problem_hash=problem_hash,
+                                       signature=signature)
+            cache_utils.flush()
         return self.model
@@ -2,10 +2,11 @@
 
 import torch
 import numpy as np
-from typing import Tuple
+from typing import Tuple, Union
 from torch.nn import Module
 from torch import Tensor
 from SALib import ProblemSpec
+from scipy.spatial import cKDTree
 
 def samples_count(second_order_interactions: bool,
                   sampling_N: int,
@@ -73,6 +74,212 @@ def bcs_reshape(bval, true_bval, bval_length) \
     return bcs
 
 
+def batch_indices(n_points: int, batch_size: int,
+                  strata: Union[list, None] = None) -> torch.Tensor:
+    """
+    Draws random indices of the collocation points for one mini-batch.
+
+    Args:
+        n_points: number of points the batch is drawn from.
+        batch_size: number of points in the batch.
+        strata: list of index tensors (e.g. one per point type). If given,
+                every stratum is sampled proportionally to its size and at least
+                one point is taken from each stratum.
+
+    Returns:
+        indices of the sampled points.
+    """
+    if strata is None:
+        return torch.randperm(n_points)[:batch_size]
+    idx = []
+    for stratum in strata:
+        n_stratum = max(1, round(batch_size * len(stratum) / n_points))
+        idx.append(stratum[torch.randperm(len(stratum))[:n_stratum]])
+    return torch.cat(idx)
+
+
+def point_coeff(coeff) -> bool:
+    """
+    Checks if the prepared coefficient is given in every point. Tensor coefficients
+    are prepared point-wise (see input_preprocessing checking_coeff), tensors of one
+    row and trainable parameters are broadcast.
+
+    Args:
+        coeff: prepared coefficient.
+
+    Returns:
+        True if the coefficient has a row for every point.
+    """
+    return isinstance(coeff, torch.Tensor) and \
+        not isinstance(coeff, torch.nn.parameter.Parameter) and \
+        coeff.dim() > 0 and coeff.shape[0] != 1
+
+
+def map_points(prepared_operator: list, mode: str, func) -> list:
+    """
+    Applies func to the point-wise fields of the prepared operator: tensor
+    coefficients, points of callable coefficients and, in 'NN' mode, shifted grids
+    of the terms. Other fields are kept.
+
+    Args:
+        prepared_operator: prepared operator (list of equations).
+        mode: calculation method (i.e., "NN", "autograd").
+        func: function of the field and its path (equation index, term label, position).
+
+    Returns:
+        prepared operator with the fields replaced.
+    """
+    result = []
+    for i, equation in enumerate(prepared_operator):
+        new_equation = {}
+        for label, term in equation.items():
+            term = dict(term)
+            coeff = term['coeff']
+            if point_coeff(coeff):
+                term['coeff'] = func(coeff, (i, label, 'coeff'))
+            elif isinstance(coeff, tuple):
+                # callable coefficient with the points it is computed in
+                term['coeff'] = (coeff[0], func(coeff[1], (i, label, 'coeff')))
+            if mode == 'NN':
+                dif_term = list(term.keys())[1]
+                grids, s_order = term[dif_term]
+                term[dif_term] = [[[func(s_grid, (i, label, k, j)) for j, s_grid in enumerate(factor)]
+                                   for k, factor in enumerate(grids)], s_order]
+            new_equation[label] = term
+        result.append(new_equation)
+    return result
+
+
+def select_points(prepared_operator: list, idx: torch.Tensor, mode: str) -> list:
+    """
+    Restricts the prepared operator to the subset of points (see map_points).
+    Tensors shared in the operator stay shared in the result. Selected fields
+    are detached, so they do not keep the graph of the grid they are computed from.
+
+    Args:
+        prepared_operator: prepared operator (list of equations).
+        idx: indices of the points subset.
+        mode: calculation method (i.e., "NN", "autograd").
+
+    Returns:
+        prepared operator restricted to the points subset.
+    """
+    memo = {}
+
+    def select(tensor, path):
+        if id(tensor) not in memo:
+            memo[id(tensor)] = (tensor, tensor[idx.to(tensor.device)].detach())
+        return memo[id(tensor)][1]
+
+    return map_points(prepared_operator, mode, select)
+
+
+def append_points(prepared_operator: list, new_operator: list, mode: str) -> list:
+    """
+    Extends the prepared operator with the operator prepared on new points.
+    Inverse operation for select_points.
+
+    Args:
+        prepared_operator: prepared operator (list of equations).
+        new_operator: the same operator prepared on new points.
+        mode: calculation method (i.e., "NN", "autograd").
+
+    Returns:
+        operator prepared on the union of points.
+    """
+    memo = {}
+
+    def field(path):
+        i, label, *position = path
+        term = new_operator[i][label]
+        if position == ['coeff']:
+            return term['coeff'][1] if isinstance(term['coeff'], tuple) else term['coeff']
+        k, j = position
+        return term[list(term.keys())[1]][0][k][j]
+
+    def append(tensor, path):
+        if id(tensor) not in memo:
+            new_tensor = field(path).reshape(-1, *tensor.shape[1:]).to(tensor)
+            memo[id(tensor)] = (tensor, torch.cat((tensor, new_tensor)))
+        return memo[id(tensor)][1]
+
+    return map_points(prepared_operator, mode, append)
+
+
+def select_bcond(bcond: dict, idx: torch.Tensor, mode: str) -> dict:
+    """
+    Restricts the prepared boundary condition to the subset of its points:
+    boundary points, values and (in 'autograd' mode) the boundary operator.
+    The boundary operator of 'NN' mode is prepared for every point type
+    separately, it is restricted by Bounds.
+
+    Args:
+        bcond: prepared boundary condition.
+        idx: indices of the points subset.
+        mode: calculation method (i.e., "NN", "autograd").
+
+    Returns:
+        boundary condition restricted to the points subset.
+    """
+    bcond = dict(bcond)
+    if isinstance(bcond['bnd'], list):
+        bcond['bnd'] = [bnd[idx.to(bnd.device)].detach() for bnd in bcond['bnd']]
+    else:
+        bcond['bnd'] = bcond['bnd'][idx.to(bcond['bnd'].device)].detach()
+    bcond['bval'] = bcond['bval'][idx.to(bcond['bval'].device)]
+    if bcond['bop'] is not None and mode == 'autograd':
+        bcond['bop'] = select_points([bcond['bop']], idx, mode)[0]
+    return bcond
+
+
+def grid_index(grid: torch.Tensor, points: torch.Tensor, tol: float = 1e-5,
+               nearest: bool = False, exact: bool = False) -> torch.Tensor:
+    """
+    Finds positions of the points in the grid. Points are matched exactly by
+    hashing of the coordinates rounded to tol, the rest points are searched
+    by the nearest neighbour query to scipy cKDTree. All points are processed
+    in bulk.
+
+    Args:
+        grid: array of a n-D points.
+        points: points to search in the grid.
+        tol: maximal distance between the point and the grid point.
+        nearest: if True, the position of the closest grid point is returned
+                 for the points which are not in the grid.
+        exact: if True, only hashing is used (points which coordinates are rounded
+               differently from the grid point are not found).
+
+    Returns:
+        positions of the points in the grid, -1 for points which are not in
+        the grid (if nearest is False).
+    """
+    device = grid.device
+    grid = grid.detach().cpu().double().reshape(len(grid), -1)
+    points = points.detach().cpu().double().reshape(len(points), -1)
+    grid_keys = torch.round(grid / tol).long()
+    point_keys = torch.round(points / tol).long()
+    # rows are hashed to one integer (overflow wraps), hash collisions are
+    # rejected by the comparison of the rounded coordinates
+    multipliers = torch.randint(1, 2 ** 62, (grid.shape[1],),
+                                generator=torch.Generator().manual_seed(0))
+    grid_hash, order = torch.sort((grid_keys * multipliers).sum(dim=1))
+    point_hash = (point_keys * multipliers).sum(dim=1)
+    loc = torch.searchsorted(grid_hash, point_hash).clamp(max=len(grid) - 1)
+    candidate = order[loc]
+    found = (grid_hash[loc] == point_hash) & (grid_keys[candidate] == point_keys).all(dim=1)
+    pos = torch.where(found, candidate, torch.full_like(candidate, -1))
+
+    missed = torch.nonzero(pos < 0).reshape(-1)
+    if len(missed) > 0 and not exact:
+        tree = cKDTree(grid.numpy())
+        dist, near = tree.query(points[missed].numpy())
+        near = torch.from_numpy(near).long()
+        if not nearest:
+            near[torch.from_numpy(dist > tol)] = -1
+        pos[missed] = near
+    return pos.to(device)
+
+
 class Lambda:
     """
     Serves for computing adaptive lambdas.